@@ -1,12 +1,13 @@
-import asyncio
+import hashlib
 import html
-import io
 import logging
 import os
 import re
+import traceback
 from datetime import datetime
 
 from telegram import (
+    ChatMember,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
     KeyboardButton,
@@ -18,6 +19,7 @@ from telegram.error import BadRequest
 from telegram.ext import (
     Application,
     CallbackQueryHandler,
+    ChatMemberHandler,
     CommandHandler,
     ConversationHandler,
     ContextTypes,
@@ -25,9 +27,13 @@ from telegram.ext import (
     filters,
 )
 
+import broadcast
 import config
 import database as db
+import executor
+import metrics
 import promo_api
+import qr_assets
 
 logging.basicConfig(
     format="%(asctime)s | %(levelname)s | %(message)s",
@@ -181,18 +187,13 @@ async def _send_main_menu_msg(update: Update):
         "Ты в деле! RAZMAN production приветствует тебя в Клубе друзей!\n\n"
         "Нажми на нужное действие 👇🏻"
     )
-    try:
-        photo = await db.get_setting("main_photo")
-    except Exception:
-        photo = None
-    if not photo:
-        photo = WELCOME_PHOTO_URL
-    if photo:
-        await update.effective_message.reply_photo(
-            photo=photo, caption=text, reply_markup=main_menu_inline()
-        )
-    else:
-        await update.effective_message.reply_text(text, reply_markup=main_menu_inline())
+    await _reply_static_photo(
+        update.effective_message,
+        "main_photo",
+        WELCOME_PHOTO_URL,
+        caption=text,
+        reply_markup=main_menu_inline(),
+    )
 
 
 def _map_kb() -> InlineKeyboardMarkup:
@@ -386,14 +387,20 @@ async def _send_offers_text(update: Update):
 
 
 # ── Onboarding ─────────────────────────────────────────────────────
-async def _events_deep_link(context: ContextTypes.DEFAULT_TYPE) -> str:
-    bot_username = (await context.bot.get_me()).username
-    return f"https://t.me/{bot_username}?start=events"
+def bot_link(bot, *, start: str | None = None, map_zone: int | None = None) -> str:
+    """
+    Ссылка на бота: ?start=<start> или Mini App карты с зоной (/map?startapp=<zone>).
+    username берётся из кэша PTB (get_me вызывается один раз в Application.initialize).
+    """
+    base = f"https://t.me/{bot.username}"
+    if map_zone is not None:
+        return f"{base}/map?startapp={map_zone}"
+    return f"{base}?start={start}" if start else base
 
 
-async def _events_broadcast_kb(context: ContextTypes.DEFAULT_TYPE) -> InlineKeyboardMarkup:
+def _events_broadcast_kb(context: ContextTypes.DEFAULT_TYPE) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
-        [InlineKeyboardButton("📅 Предстоящие события", url=await _events_deep_link(context))],
+        [InlineKeyboardButton("📅 Предстоящие события", url=bot_link(context.bot, start="events"))],
     ])
 
 
@@ -627,8 +634,9 @@ async def _send_exhibition(message):
     kb = InlineKeyboardMarkup([
         [InlineKeyboardButton("🎟 Купить билет", url=TICKET_URL)],
     ])
-    photo = await _event_photo("exhibition_photo_v2", EXHIBITION_PHOTO_URL)
-    await message.reply_photo(photo=photo, caption=text, reply_markup=kb)
+    await _reply_static_photo(
+        message, "exhibition_photo_v2", EXHIBITION_PHOTO_URL, caption=text, reply_markup=kb
+    )
 
 
 EVENT_SADY_TEXT = (
@@ -674,12 +682,37 @@ EVENT_AKSYUTIK_TEXT = (
 )
 
 
-async def _event_photo(setting_key: str, fallback_url: str) -> str:
+async def _reply_static_photo(message, setting_key: str, fallback_url: str, **kwargs):
+    """
+    Фото раздела: заданное админом (file_id в settings) или картинка по URL.
+    Для URL после первой отправки запоминаем file_id (ключ содержит URL — новый URL
+    даёт новый ключ), чтобы Telegram не скачивал файл с GitHub Pages при каждом показе.
+    """
     try:
         photo = await db.get_setting(setting_key)
     except Exception:
         photo = None
-    return photo or fallback_url
+    if photo:
+        return await message.reply_photo(photo=photo, **kwargs)
+
+    cache_key = f"file_id:{fallback_url}"
+    try:
+        file_id = await db.get_setting(cache_key)
+    except Exception:
+        file_id = None
+    if file_id:
+        try:
+            return await message.reply_photo(photo=file_id, **kwargs)
+        except BadRequest as e:
+            logger.warning("cached file_id for %s rejected, re-uploading: %s", fallback_url, e)
+
+    sent = await message.reply_photo(photo=fallback_url, **kwargs)
+    if sent.photo:
+        try:
+            await db.set_setting(cache_key, sent.photo[-1].file_id)
+        except db.TursoError as e:
+            logger.warning("could not cache file_id for %s: %s", fallback_url, e)
+    return sent
 
 
 async def _send_events_hub(message):
@@ -688,21 +721,25 @@ async def _send_events_hub(message):
 
 
 async def _send_event_sady(message):
-    photo = await _event_photo("event_sady_photo_v2", EVENT_SADY_PHOTO_URL)
     kb = InlineKeyboardMarkup([
         [InlineKeyboardButton("Подробнее", url=EVENT_SADY_INFO_URL)],
         [InlineKeyboardButton("← К событиям", callback_data="cb_events")],
     ])
-    await message.reply_photo(photo=photo, caption=EVENT_SADY_TEXT, reply_markup=kb)
+    await _reply_static_photo(
+        message, "event_sady_photo_v2", EVENT_SADY_PHOTO_URL,
+        caption=EVENT_SADY_TEXT, reply_markup=kb,
+    )
 
 
 async def _send_event_aksyutik(message):
-    photo = await _event_photo("event_aksyutik_photo_v2", EVENT_AKSYUTIK_PHOTO_URL)
     kb = InlineKeyboardMarkup([
         [InlineKeyboardButton("🎟 Купить билет", url=EVENT_AKSYUTIK_TICKET_URL)],
         [InlineKeyboardButton("← К событиям", callback_data="cb_events")],
     ])
-    await message.reply_photo(photo=photo, caption=EVENT_AKSYUTIK_TEXT, reply_markup=kb)
+    await _reply_static_photo(
+        message, "event_aksyutik_photo_v2", EVENT_AKSYUTIK_PHOTO_URL,
+        caption=EVENT_AKSYUTIK_TEXT, reply_markup=kb,
+    )
 
 
 async def _send_announcements(message):
@@ -1156,6 +1193,19 @@ async def review_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ConversationHandler.END
 
 
+# ── Bot blocked / unblocked ────────────────────────────────────────
+async def handle_my_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Пользователь заблокировал бота или снова запустил его — учитываем в рассылках."""
+    member = update.my_chat_member
+    if member.chat.type != "private":
+        return
+    status = member.new_chat_member.status
+    if status == ChatMember.BANNED:
+        await db.set_user_reachable(member.from_user.id, False)
+    elif status == ChatMember.MEMBER:
+        await db.set_user_reachable(member.from_user.id, True)
+
+
 # ── Admin commands ─────────────────────────────────────────────────
 async def cmd_setphoto(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id):
@@ -1264,12 +1314,6 @@ async def cmd_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     msg = update.message
-    user_ids = await db.get_all_user_ids()
-
-    if not user_ids:
-        await msg.reply_text("Нет пользователей для рассылки.")
-        return
-
     text = " ".join(context.args) if context.args else None
     has_photo = bool(msg.photo)
     has_animation = bool(msg.animation)
@@ -1285,67 +1329,46 @@ async def cmd_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     caption = msg.caption.replace("/broadcast", "").strip() if msg.caption else None
-    status = await msg.reply_text(f"📤 Начинаю рассылку для {len(user_ids)} пользователей...")
+    if has_photo:
+        payload = broadcast.make_payload(
+            "Рассылка", "send_photo", photo=msg.photo[-1].file_id, caption=caption
+        )
+    elif has_animation:
+        payload = broadcast.make_payload(
+            "Рассылка", "send_animation", animation=msg.animation.file_id, caption=caption
+        )
+    else:
+        payload = broadcast.make_payload("Рассылка", "send_message", text=text)
+    await _start_broadcast(context, msg, payload)
 
-    sent, failed = 0, 0
-    for user_id in user_ids:
-        try:
-            if has_photo:
-                await context.bot.send_photo(
-                    chat_id=user_id, photo=msg.photo[-1].file_id, caption=caption
-                )
-            elif has_animation:
-                await context.bot.send_animation(
-                    chat_id=user_id, animation=msg.animation.file_id, caption=caption
-                )
-            else:
-                await context.bot.send_message(chat_id=user_id, text=text)
-            sent += 1
-        except Exception:
-            failed += 1
-        await asyncio.sleep(0.05)
 
-    await status.edit_text(
-        f"✅ Рассылка завершена\n\nОтправлено: {sent}\nНе доставлено: {failed}"
-    )
+async def _start_broadcast(context: ContextTypes.DEFAULT_TYPE, msg, payload: dict):
+    status = await msg.reply_text("📤 Готовлю рассылку...")
+    job = await broadcast.start(context.application, payload, status)
+    if not job["total"]:
+        await status.edit_text("Нет пользователей для рассылки.")
+        return
+    await status.edit_text(f"📤 Начинаю рассылку для {job['total']} пользователей...")
 
 
 async def cmd_broadcastevents(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id):
         return
 
-    msg = update.message
-    user_ids = await db.get_all_user_ids()
-    if not user_ids:
-        await msg.reply_text("Нет пользователей для рассылки.")
-        return
-
-    kb = await _events_broadcast_kb(context)
-    status = await msg.reply_text(f"📤 Начинаю рассылку для {len(user_ids)} пользователей...")
-
-    sent, failed = 0, 0
-    for user_id in user_ids:
-        try:
-            await context.bot.send_message(
-                chat_id=user_id,
-                text=BROADCAST_EVENTS_TEXT,
-                reply_markup=kb,
-            )
-            sent += 1
-        except Exception:
-            failed += 1
-        await asyncio.sleep(0.05)
-
-    await status.edit_text(
-        f"✅ Рассылка «Предстоящие события» завершена\n\n"
-        f"Отправлено: {sent}\nНе доставлено: {failed}"
+    kb = _events_broadcast_kb(context)
+    payload = broadcast.make_payload(
+        "Рассылка «Предстоящие события»",
+        "send_message",
+        text=BROADCAST_EVENTS_TEXT,
+        reply_markup=kb,
     )
+    await _start_broadcast(context, update.message, payload)
 
 
 async def cmd_eventslink(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id):
         return
-    url = await _events_deep_link(context)
+    url = bot_link(context.bot, start="events")
     await update.message.reply_text(
         f"Ссылка на раздел «Предстоящие события»:\n{url}\n\n"
         "Рассылка: /broadcastevents",
@@ -1356,20 +1379,44 @@ async def cmd_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id):
         return
     stats = await db.get_stats()
-    lines = [f"📊 Всего пользователей: *{stats['total']}*\n\nПоследние 5:"]
+    unreachable = stats["unreachable"]
+    lines = [
+        f"📊 Всего пользователей: *{stats['total']}*\n"
+        f"Доступны для рассылки: {stats['reachable']}\n"
+        f"Недоступны: {sum(unreachable.values())}"
+        f" (заблокировали бота: {unreachable.get('blocked', 0)},"
+        f" удалённые аккаунты: {unreachable.get('deactivated', 0)},"
+        f" чат не найден: {unreachable.get('chat_not_found', 0)})"
+        "\n\nПоследние 5:"
+    ]
     for first_name, username, joined_at in stats["recent"]:
         uname = f"@{username}" if username else "—"
         lines.append(f"• {first_name} ({uname}) — {joined_at}")
+    cache = db.profile_cache_stats()
+    lines.append(
+        f"\nКэш профилей: {cache['size']} записей, попаданий {cache['hits']}, промахов {cache['misses']}"
+    )
+    loop = executor.loop_stats()
+    lines.append(
+        f"Event loop: задержка {loop['last_lag_ms']:.0f} мс, максимум {loop['max_lag_ms']:.0f} мс,"
+        f" блокировок {loop['stalls']}"
+    )
     await update.message.reply_text("\n".join(lines), parse_mode="Markdown")
 
 
 async def cmd_export(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id):
         return
-    csv_data = await db.export_csv()
-    file = io.BytesIO(csv_data.encode("utf-8"))
-    file.name = "contacts.csv"
-    await update.message.reply_document(document=file, filename="contacts.csv")
+    compress = _export_compress(context)
+    with await db.export_csv(compress=compress) as file:
+        await update.message.reply_document(
+            document=file, filename="contacts.csv.gz" if compress else "contacts.csv"
+        )
+
+
+def _export_compress(context: ContextTypes.DEFAULT_TYPE) -> bool:
+    """/export gz, /exportreviews gz — файл в gzip."""
+    return bool(context.args) and context.args[0].lower() in ("gz", "gzip")
 
 
 async def cmd_reviews(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1397,24 +1444,20 @@ async def cmd_reviews(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def cmd_export_reviews(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id):
         return
-    csv_data = await db.export_reviews_csv()
-    file = io.BytesIO(csv_data.encode("utf-8"))
-    await update.message.reply_document(document=file, filename="reviews.csv")
+    compress = _export_compress(context)
+    with await db.export_reviews_csv(compress=compress) as file:
+        await update.message.reply_document(
+            document=file, filename="reviews.csv.gz" if compress else "reviews.csv"
+        )
 
 
 async def cmd_qr(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id):
         return
     try:
-        import qrcode
-        bot_username = (await context.bot.get_me()).username
-        url = f"https://t.me/{bot_username}?start=qr"
-        img = qrcode.make(url)
-        buf = io.BytesIO()
-        img.save(buf, format="PNG")
-        buf.seek(0)
-        await update.message.reply_photo(
-            photo=buf, caption=f"QR-код ведёт на: `{url}`", parse_mode="Markdown"
+        url = bot_link(context.bot, start="qr")
+        await qr_assets.reply_qr(
+            update.message, url, caption=f"QR-код ведёт на: `{url}`", parse_mode="Markdown"
         )
     except ImportError:
         await update.message.reply_text("Установи пакет: pip install qrcode[pil]")
@@ -1557,60 +1600,277 @@ async def cmd_userpromo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
+def _format_ms(ms: float | None) -> str:
+    if ms is None:
+        return "—"
+    return f"≤{ms:.0f} мс" if ms != float("inf") else ">5 с"
+
+
+async def cmd_apiclient(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id):
+        return
+    msg = update.effective_message
+    if not msg:
+        return
+    args = context.args or []
+    action = args[0].lower() if args else "list"
+
+    if action == "add" and len(args) >= 2:
+        name = args[1]
+        endpoints = None
+        discount = None
+        for arg in args[2:]:
+            if arg.rstrip("%").isdigit():
+                discount = int(arg.rstrip("%"))
+            elif arg.lower() != "all":
+                endpoints = [e.strip() for e in arg.lower().split(",") if e.strip()]
+        unknown = [e for e in endpoints or [] if e not in promo_api.ENDPOINTS]
+        if unknown:
+            await msg.reply_text(
+                f"Неизвестные эндпоинты: {', '.join(unknown)}\n"
+                f"Доступны: {', '.join(promo_api.ENDPOINTS)}"
+            )
+            return
+        try:
+            client, secret = await db.create_api_client(
+                name, endpoints=endpoints, discount_percent=discount
+            )
+        except ValueError as e:
+            await msg.reply_text(str(e))
+            return
+        await promo_api.refresh_clients()
+        await msg.reply_text(
+            f"✅ Клиент <b>{html.escape(client['name'])}</b> создан\n"
+            f"Эндпоинты: {html.escape(', '.join(client['endpoints'] or ['все']))}\n"
+            f"Скидка: {client['discount_percent'] if client['discount_percent'] is not None else 'по умолчанию'}\n\n"
+            f"Секрет (показывается один раз, в базе хранится только хэш):\n"
+            f"<code>{secret}</code>",
+            parse_mode="HTML",
+        )
+        return
+
+    if action in ("revoke", "enable") and len(args) >= 2:
+        if not await db.set_api_client_active(args[1], action == "enable"):
+            await msg.reply_text(f"Клиент {args[1]} не найден.")
+            return
+        await promo_api.refresh_clients()
+        state = "включён ✅" if action == "enable" else "отключён ⛔️"
+        await msg.reply_text(f"Клиент {args[1]} {state}")
+        return
+
+    if action != "list":
+        await msg.reply_text(
+            "Использование:\n"
+            "/apiclient — клиенты API и их нагрузка\n"
+            "/apiclient add <имя> [эндпоинты через запятую | all] [скидка %]\n"
+            "/apiclient revoke <имя>\n"
+            "/apiclient enable <имя>\n\n"
+            f"Эндпоинты: {', '.join(promo_api.ENDPOINTS)}"
+        )
+        return
+
+    clients = await db.get_api_clients()
+    usage = await promo_api.client_usage()
+    lines = [
+        f"🔑 <b>Клиенты API</b> (нагрузка за {promo_api.USAGE_WINDOW_HOURS} ч, все процессы)\n"
+    ]
+    names = ["default"] + [c["name"] for c in clients] + ["anonymous"]
+    info = {c["name"]: c for c in clients}
+    for name in names:
+        client = info.get(name)
+        u = usage.get(name)
+        if client is None and u is None and name != "default":
+            continue
+        head = f"<b>{html.escape(name)}</b>"
+        if client is not None:
+            head += " ✅" if client["active"] else " ⛔️"
+            head += f" · {html.escape(', '.join(client['endpoints'] or ['все']))}"
+            if client["discount_percent"] is not None:
+                head += f" · скидка {client['discount_percent']}%"
+        lines.append(head)
+        if u:
+            lines.append(
+                f"  запросов {u['requests']}, ошибок {u['error_rate']:.0%},"
+                f" p50 {_format_ms(u['p50_ms'])}, p95 {_format_ms(u['p95_ms'])}"
+            )
+    await msg.reply_text("\n".join(lines), parse_mode="HTML")
+
+
+_DBPROFILE_DEFAULT = 10
+_DBPROFILE_MAX = 25
+_DBPROFILE_SQL_LEN = 200
+_MESSAGE_LIMIT = 4096
+
+
+async def cmd_dbprofile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id):
+        return
+    msg = update.effective_message
+    if not msg:
+        return
+    args = context.args or []
+    if args and args[0].lower() == "reset":
+        db.reset_query_profile()
+        await msg.reply_text("Профиль запросов обнулён.")
+        return
+    limit = int(args[0]) if args and args[0].isdigit() else _DBPROFILE_DEFAULT
+    profile = db.query_profile(max(1, min(limit, _DBPROFILE_MAX)))
+    if not profile:
+        await msg.reply_text("Запросов к Turso с запуска процесса не было.")
+        return
+
+    blocks = ["🐢 <b>Запросы к Turso</b> по суммарному времени (с запуска процесса)"]
+    for i, q in enumerate(profile, 1):
+        callers = sorted(q["callers"].items(), key=lambda item: item[1], reverse=True)
+        sql = q["sql"] if len(q["sql"]) <= _DBPROFILE_SQL_LEN else q["sql"][:_DBPROFILE_SQL_LEN] + "…"
+        head = (
+            f"{i}. <b>{q['total_ms']:.0f} мс</b> · вызовов {q['calls']}"
+            f" · ср. {q['total_ms'] / q['calls']:.0f} мс · макс {q['max_ms']:.0f} мс"
+            f" · строк/вызов {q['rows'] / q['calls']:.1f}"
+        )
+        if q["retries"]:
+            head += f" · повторов {q['retries']}"
+        if q["errors"]:
+            head += f" · ошибок {q['errors']}"
+        blocks.append(
+            f"{head}\n"
+            f"{html.escape(', '.join(f'{name} ×{count}' for name, count in callers[:3]))}\n"
+            f"<code>{html.escape(sql)}</code>"
+        )
+    # Лимит Telegram — 4096 символов: длинный топ уходит несколькими сообщениями.
+    text = ""
+    for block in blocks:
+        if text and len(text) + len(block) + 2 > _MESSAGE_LIMIT:
+            await msg.reply_text(text, parse_mode="HTML")
+            text = ""
+        text = f"{text}\n\n{block}" if text else block
+    await msg.reply_text(text, parse_mode="HTML")
+
+
 async def cmd_qrzone(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id):
         return
     try:
-        import qrcode
+        if context.args and context.args[0].lower() == "all":
+            await _send_qr_bundle(update, context)
+            return
         if not context.args or not context.args[0].isdigit():
             zones = "\n".join(f"{k} — {v}" for k, v in ZONE_NAMES.items())
-            await update.message.reply_text(f"Использование: /qrzone <номер>\n\nЛокации:\n{zones}")
+            await update.message.reply_text(
+                "Использование: /qrzone <номер>\n"
+                "/qrzone all — ZIP со всеми QR, /qrzone all pdf — лист A4 для печати\n\n"
+                f"Локации:\n{zones}"
+            )
             return
         zone_id = int(context.args[0])
         if zone_id not in ZONE_NAMES:
             await update.message.reply_text("Номер локации: от 1 до 21")
             return
-        bot_username = (await context.bot.get_me()).username
-        url = f"https://t.me/{bot_username}/map?startapp={zone_id}"
-        img = qrcode.make(url)
-        buf = io.BytesIO()
-        img.save(buf, format="PNG")
-        buf.seek(0)
-        await update.message.reply_photo(
-            photo=buf, caption=f"📍 Локация {zone_id}: {ZONE_NAMES[zone_id]}\n\n{url}"
+        url = bot_link(context.bot, map_zone=zone_id)
+        await qr_assets.reply_qr(
+            update.message, url, caption=f"📍 Локация {zone_id}: {ZONE_NAMES[zone_id]}\n\n{url}"
         )
     except ImportError:
         await update.message.reply_text("Установи пакет: pip install qrcode[pil]")
 
 
+def _qr_targets(bot) -> list[tuple[str, str, str]]:
+    """(подпись для листа, имя файла, url): главный QR бота и QR всех зон карты."""
+    targets = [("BOT", "00-bot.png", bot_link(bot, start="qr"))]
+    for zone_id, name in ZONE_NAMES.items():
+        targets.append((str(zone_id), f"{zone_id:02d}-{name}.png", bot_link(bot, map_zone=zone_id)))
+    return targets
+
+
+async def _send_qr_bundle(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    targets = _qr_targets(context.bot)
+    if len(context.args) > 1 and context.args[1].lower() == "pdf":
+        data = await qr_assets.build_pdf_sheet([(label, url) for label, _, url in targets])
+        filename = "qr-sheet.pdf"
+    else:
+        data = await qr_assets.build_zip([(name, url) for _, name, url in targets])
+        filename = "qr-zones.zip"
+    await update.message.reply_document(document=data, filename=filename)
+
+
 # ── Main ───────────────────────────────────────────────────────────
+async def _report_giveaway_number_changes(bot) -> None:
+    """Сообщает админам о номерах розыгрыша, сменённых миграцией (повторы после старых гонок)."""
+    changes = await db.get_unreported_giveaway_number_changes()
+    if not changes:
+        return
+    lines = [f"id {c['user_id']}: №{c['old_number']} → №{c['new_number']}" for c in changes]
+    logger.warning("Номера розыгрыша перенумерованы миграцией: %s", "; ".join(lines))
+    shown = lines[:50]
+    if len(lines) > len(shown):
+        shown.append(f"… и ещё {len(lines) - len(shown)} (полный список — в логе)")
+    msg = (
+        "⚠️ <b>Повторяющиеся номера розыгрыша заменены</b>\n\n"
+        "Эти пользователи уже видели старый номер:\n" + "\n".join(shown)
+    )
+    for admin_id in list(config.ADMIN_IDS):
+        try:
+            await bot.send_message(admin_id, msg, parse_mode='HTML')
+        except Exception:
+            pass
+    await db.mark_giveaway_number_changes_reported([c["id"] for c in changes])
+
+
+BOT_COMMANDS = [
+    ("menu",          "Главное меню"),
+    ("exhibition",    "Выставка «Небо.Река» 🎨"),
+    ("map",           "Карта выставки 🗺"),
+    ("offers",        "Специальные предложения 💝"),
+    ("certificates",  "Подарочные сертификаты 🎁"),
+    ("faq",           "Часто задаваемые вопросы ❓"),
+    ("contact",       "Связаться с нами 📞"),
+    ("review",        "Оставить отзыв ⭐️"),
+    ("about",         "О RAZMAN production ℹ️"),
+]
+
+
 def main():
     if not config.BOT_TOKEN:
         raise RuntimeError("BOT_TOKEN не задан в .env файле")
     if not config.TURSO_URL or not config.TURSO_TOKEN:
         raise RuntimeError("TURSO_URL или TURSO_TOKEN не заданы в .env файле")
 
+    metrics_server = None
+
     async def post_init(application):
+        nonlocal metrics_server
+        application.create_task(executor.run_loop_monitor())
+        if config.METRICS_PORT:
+            # В webhook-режиме /metrics с METRICS_TOKEN есть и на порту webhook (promo_api.ROUTES).
+            metrics_server = metrics.start_server(config.METRICS_PORT)
+            logger.info("Метрики: GET /metrics на порту %s", config.METRICS_PORT)
         await db.init_db()
-        await application.bot.set_my_commands([
-            ("menu",          "Главное меню"),
-            ("exhibition",    "Выставка «Небо.Река» 🎨"),
-            ("map",           "Карта выставки 🗺"),
-            ("offers",        "Специальные предложения 💝"),
-            ("certificates",  "Подарочные сертификаты 🎁"),
-            ("faq",           "Часто задаваемые вопросы ❓"),
-            ("contact",       "Связаться с нами 📞"),
-            ("review",        "Оставить отзыв ⭐️"),
-            ("about",         "О RAZMAN production ℹ️"),
-        ])
+        await _report_giveaway_number_changes(application.bot)
+        if db.replica_enabled():
+            application.create_task(db.run_replica_sync())
+        application.create_task(db.run_settings_refresh())
+        await broadcast.resume_unfinished(application)
+        application.create_task(
+            qr_assets.prerender([url for _, _, url in _qr_targets(application.bot)])
+        )
+        # set_my_commands — только если список команд изменился с прошлого запуска.
+        commands_hash = hashlib.sha256(repr(BOT_COMMANDS).encode()).hexdigest()
+        if await db.get_setting("bot_commands_hash") != commands_hash:
+            await application.bot.set_my_commands(BOT_COMMANDS)
+            await db.set_setting("bot_commands_hash", commands_hash)
 
-    async def error_handler(update, context):
-        import traceback
-        logger.error("Ошибка: %s", context.error, exc_info=context.error)
+    async def post_shutdown(application):
+        if metrics_server is not None:
+            metrics_server.stop()
+        executor.shutdown()
 
-        tb = ''.join(traceback.format_exception(
-            type(context.error), context.error, context.error.__traceback__
+    async def error_handler(update, context):
+        # Форматирование трейсбека (чтение исходников с диска) — вне event loop.
+        tb = ''.join(await executor.run_blocking(
+            traceback.format_exception,
+            type(context.error), context.error, context.error.__traceback__,
         ))
+        logger.error("Ошибка: %s\n%s", context.error, tb)
 
         user_info = ''
         if update and update.effective_user:
@@ -1629,7 +1889,13 @@ def main():
             except Exception:
                 pass
 
-    app = Application.builder().token(config.BOT_TOKEN).post_init(post_init).build()
+    app = (
+        Application.builder()
+        .token(config.BOT_TOKEN)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
     app.add_error_handler(error_handler)
 
     # Review ConversationHandler — первым, чтобы перехватывал раньше других
@@ -1700,6 +1966,8 @@ def main():
     app.add_handler(CommandHandler("revokepromo", cmd_revokepromo))
     app.add_handler(CommandHandler("reissuepromo", cmd_reissuepromo))
     app.add_handler(CommandHandler("userpromo", cmd_userpromo))
+    app.add_handler(CommandHandler("apiclient", cmd_apiclient))
+    app.add_handler(CommandHandler("dbprofile", cmd_dbprofile))
     app.add_handler(MessageHandler(filters.PHOTO & filters.CaptionRegex(r"(?i)/setphoto"), cmd_setphoto))
     app.add_handler(MessageHandler(filters.PHOTO & filters.CaptionRegex(r"(?i)/setsadyphoto"), cmd_setsadyphoto))
     app.add_handler(MessageHandler(
@@ -1732,6 +2000,8 @@ def main():
     app.add_handler(CallbackQueryHandler(cb_contact,     pattern="^cb_contact$"))
     app.add_handler(CallbackQueryHandler(cb_about,       pattern="^cb_about$"))
 
+    app.add_handler(ChatMemberHandler(handle_my_chat_member, ChatMemberHandler.MY_CHAT_MEMBER))
+
     # Message handlers
     app.add_handler(MessageHandler(filters.CONTACT, handle_contact))
     app.add_handler(MessageHandler(filters.Regex(r"^Нет, не хочу$"), handle_final_skip))
@@ -1740,16 +2010,22 @@ def main():
     app.add_handler(MessageHandler(filters.Regex(RE_MENU_OFFERS),  handle_offers_menu))
     app.add_handler(MessageHandler(filters.Regex(RE_MENU_CONTACT), handle_contact_menu))
 
+    metrics.instrument_application(app)
+
     webhook_url = config.WEBHOOK_URL
     port = int(os.environ.get("PORT", 8443))
 
     if webhook_url:
         if not config.PROMO_API_SECRET:
             logger.warning(
-                "PROMO_API_SECRET не задан — POST /api/promo/redeem будет возвращать 401"
+                "PROMO_API_SECRET не задан — API промокодов доступен только клиентам из /apiclient"
             )
         promo_api.patch_webhook_app()
-        logger.info("Promo API: POST /api/promo/redeem")
+        logger.info(
+            "Promo API: POST /api/promo/redeem, /api/promo/{redeem,validate}/batch;"
+            " GET /api/promo/{code}%s",
+            ", /metrics" if config.METRICS_TOKEN else "",
+        )
         logger.info("Запуск в режиме webhook: %s", webhook_url)
         app.run_webhook(
             listen="0.0.0.0",
@@ -1758,7 +2034,7 @@ def main():
             url_path="/webhook",
         )
     else:
-        logger.info("Запуск в режиме polling")
+        logger.info("Запуск в режиме polling (API промокодов: python -m promo_api)")
         app.run_polling(allowed_updates=Update.ALL_TYPES)
 
 
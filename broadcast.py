@@ -0,0 +1,238 @@
+"""Рассылки: общий лимит скорости, параллельная отправка, прогресс и возобновление после рестарта."""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from datetime import timedelta
+
+from telegram import Bot, InlineKeyboardMarkup
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
+from telegram.ext import Application
+
+import config
+import database as db
+import metrics
+
+logger = logging.getLogger(__name__)
+
+_WORKERS = 8
+_SEND_ATTEMPTS = 3
+_FLUSH_INTERVAL = 2.0
+_FLUSH_BATCH = 200
+_PROGRESS_INTERVAL = 5.0
+
+_MESSAGES = metrics.Counter(
+    "broadcast_messages_total",
+    "Получатели рассылок по результату: sent, failed, blocked, deactivated, chat_not_found",
+    ("status",),
+)
+_FLOOD_WAIT = metrics.Counter(
+    "broadcast_flood_wait_seconds_total", "Суммарная пауза рассылок по RetryAfter от Telegram"
+)
+
+
+class TokenBucket:
+    """Token bucket: не больше rate сообщений в секунду, всплеск до burst."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.capacity = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds: float) -> None:
+        """Flood wait от Telegram: останавливает всех отправителей."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0.0
+
+
+# Один лимитер на процесс — лимит Telegram общий для бота, а не для рассылки.
+_limiter = TokenBucket(config.BROADCAST_RATE, burst=max(1, int(config.BROADCAST_RATE)))
+
+
+def _seconds(retry_after: int | float | timedelta) -> float:
+    if isinstance(retry_after, timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+
+def make_payload(
+    title: str,
+    method: str,
+    *,
+    reply_markup: InlineKeyboardMarkup | None = None,
+    **kwargs,
+) -> dict:
+    """Payload задания: метод Bot (send_message | send_photo | send_animation) и его аргументы."""
+    if reply_markup is not None:
+        kwargs["reply_markup"] = reply_markup.to_dict()
+    return {"title": title, "method": method, "kwargs": kwargs}
+
+
+async def start(application: Application, payload: dict, status_message) -> dict:
+    """Создаёт задание и запускает его в фоне; обработчик команды не ждёт окончания."""
+    job = await db.create_broadcast_job(payload, status_message.chat_id, status_message.message_id)
+    if not job["total"]:
+        await db.finish_broadcast_job(job["id"])
+        return job
+    application.create_task(_run_job(application.bot, job), name=f"broadcast-{job['id']}")
+    return job
+
+
+async def resume_unfinished(application: Application) -> None:
+    """Продолжает рассылки, прерванные рестартом (вызывается из post_init)."""
+    for job in await db.get_running_broadcast_jobs():
+        logger.info(
+            "Возобновляю рассылку #%s (%s/%s)",
+            job["id"], job["sent"] + job["failed"], job["total"],
+        )
+        application.create_task(_run_job(application.bot, job), name=f"broadcast-{job['id']}")
+
+
+async def _send(bot: Bot, user_id: int, method: str, kwargs: dict) -> str:
+    """Статус получателя: sent | failed | blocked | deactivated | chat_not_found."""
+    for attempt in range(_SEND_ATTEMPTS):
+        await _limiter.acquire()
+        try:
+            await getattr(bot, method)(chat_id=user_id, **kwargs)
+            return "sent"
+        except RetryAfter as exc:
+            delay = _seconds(exc.retry_after)
+            logger.warning("Flood wait %.0f с в рассылке", delay)
+            _FLOOD_WAIT.inc(amount=delay)
+            _limiter.pause(delay)
+        except Forbidden as exc:
+            return "deactivated" if "deactivated" in str(exc).lower() else "blocked"
+        except BadRequest as exc:
+            return "chat_not_found" if "chat not found" in str(exc).lower() else "failed"
+        except NetworkError:
+            if attempt == _SEND_ATTEMPTS - 1:
+                return "failed"
+        except TelegramError:
+            return "failed"
+    return "failed"
+
+
+def _progress_text(
+    job: dict, sent: int, failed: int, *, finished: bool, interrupted: bool = False
+) -> str:
+    if interrupted:
+        return (
+            f"⚠️ {job['payload']['title']} прервана ошибкой: {sent + failed}/{job['total']}\n\n"
+            f"Отправлено: {sent}\nНе доставлено: {failed}"
+        )
+    if finished:
+        return (
+            f"✅ {job['payload']['title']} завершена\n\n"
+            f"Отправлено: {sent}\nНе доставлено: {failed}"
+        )
+    return (
+        f"📤 {job['payload']['title']}: {sent + failed}/{job['total']}\n\n"
+        f"Отправлено: {sent}\nНе доставлено: {failed}"
+    )
+
+
+async def _edit_progress(bot: Bot, job: dict, text: str) -> None:
+    if job["status_chat_id"] is None or job["status_message_id"] is None:
+        return
+    try:
+        await bot.edit_message_text(
+            text,
+            chat_id=job["status_chat_id"],
+            message_id=job["status_message_id"],
+        )
+    except TelegramError as e:
+        if "message is not modified" not in str(e).lower():
+            logger.warning("broadcast progress edit failed: %s", e)
+
+
+async def _run_job(bot: Bot, job: dict) -> None:
+    payload = job["payload"]
+    kwargs = dict(payload["kwargs"])
+    if "reply_markup" in kwargs:
+        kwargs["reply_markup"] = InlineKeyboardMarkup.de_json(kwargs["reply_markup"], bot)
+
+    queue: asyncio.Queue[int] = asyncio.Queue()
+    for user_id in await db.get_broadcast_pending_user_ids(job["id"]):
+        queue.put_nowait(user_id)
+
+    sent, failed = job["sent"], job["failed"]
+    pending: list[tuple[int, str]] = []
+
+    async def flush() -> None:
+        batch = pending[:]
+        pending.clear()
+        try:
+            await db.record_broadcast_results(job["id"], batch)
+        except db.TursoError as e:
+            # Не записали — после рестарта эти получатели получат сообщение повторно.
+            logger.warning("broadcast #%s: не удалось сохранить прогресс: %s", job["id"], e)
+
+    async def worker() -> None:
+        nonlocal sent, failed
+        while True:
+            try:
+                user_id = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            status = await _send(bot, user_id, payload["method"], kwargs)
+            _MESSAGES.inc(status)
+            if status == "sent":
+                sent += 1
+            else:
+                failed += 1
+            pending.append((user_id, status))
+
+    workers = [asyncio.create_task(worker()) for _ in range(_WORKERS)]
+    interrupted = False
+    try:
+        last_flush = last_progress = time.monotonic()
+        while not all(w.done() for w in workers):
+            await asyncio.sleep(0.5)
+            now = time.monotonic()
+            if len(pending) >= _FLUSH_BATCH or (pending and now - last_flush >= _FLUSH_INTERVAL):
+                await flush()
+                last_flush = now
+            if now - last_progress >= _PROGRESS_INTERVAL:
+                await _edit_progress(bot, job, _progress_text(job, sent, failed, finished=False))
+                last_progress = now
+        await asyncio.gather(*workers)
+    except Exception:
+        logger.exception("Рассылка #%s прервана ошибкой", job["id"])
+        interrupted = True
+    finally:
+        # Уже отправленное сохраняем при любом выходе (ошибка, отмена при остановке бота),
+        # иначе после рестарта эти получатели получат сообщение повторно.
+        for w in workers:
+            w.cancel()
+        await flush()
+
+    if interrupted:
+        # Не возобновляем после рестарта: причина ошибки скорее всего никуда не делась.
+        await db.finish_broadcast_job(job["id"], status="failed")
+        await _edit_progress(
+            bot, job, _progress_text(job, sent, failed, finished=True, interrupted=True)
+        )
+        return
+
+    await db.finish_broadcast_job(job["id"])
+    logger.info("Рассылка #%s завершена: отправлено %s, не доставлено %s", job["id"], sent, failed)
+    await _edit_progress(bot, job, _progress_text(job, sent, failed, finished=True))
@@ -13,3 +13,35 @@ TURSO_TOKEN = os.getenv("TURSO_TOKEN", "")
 # API погашения промокодов NR-* для внешних приложений (POST /api/promo/redeem)
 PROMO_API_SECRET = os.getenv("PROMO_API_SECRET", "")
 PROMO_DISCOUNT_PERCENT = int(os.getenv("PROMO_DISCOUNT_PERCENT", "10"))
+# Максимум кодов в одном запросе /api/promo/redeem/batch и /api/promo/validate/batch
+PROMO_API_BATCH_LIMIT = int(os.getenv("PROMO_API_BATCH_LIMIT", "100"))
+# Сколько секунд GET /api/promo/{code} отдаёт ответ из памяти (и max-age для клиента)
+PROMO_API_LOOKUP_TTL = int(os.getenv("PROMO_API_LOOKUP_TTL", "5"))
+# Лимиты API: запросов в секунду с одного IP и на клиента (всплеск — вдвое больше);
+# после стольких 401/404 (счёт обнуляется через час без них) — блокировка 30 с, каждая следующая вдвое дольше
+PROMO_API_RATE = float(os.getenv("PROMO_API_RATE", "10"))
+PROMO_API_CLIENT_RATE = float(os.getenv("PROMO_API_CLIENT_RATE", "50"))
+PROMO_API_LOCKOUT_AFTER = int(os.getenv("PROMO_API_LOCKOUT_AFTER", "20"))
+# Прокси перед API, которым верим X-Forwarded-For: адреса/подсети через запятую или "*" (Render).
+# Пусто — заголовок игнорируется, лимиты считаются по адресу соединения.
+PROMO_API_TRUSTED_PROXIES = os.getenv("PROMO_API_TRUSTED_PROXIES", "")
+# Как часто (с) подтягивать изменения таблицы клиентов API (добавлены/отключены в другом процессе)
+PROMO_API_CLIENTS_POLL = float(os.getenv("PROMO_API_CLIENTS_POLL", "30"))
+# Отдельный сервер API (python -m promo_api): порт и число процессов (0 — по числу CPU)
+PROMO_API_PORT = int(os.getenv("PROMO_API_PORT") or os.getenv("PORT") or "8080")
+PROMO_API_WORKERS = int(os.getenv("PROMO_API_WORKERS", "1"))
+
+# Рассылки: сообщений в секунду на весь бот (лимит Telegram ~30/с, часть оставляем на ответы)
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))
+
+# Блокирующая работа вне event loop: потоки для I/O, процессы для CPU (0 — тоже потоки)
+BLOCKING_POOL_SIZE = int(os.getenv("BLOCKING_POOL_SIZE", "4"))
+CPU_POOL_SIZE = int(os.getenv("CPU_POOL_SIZE", "0"))
+# Порог, после которого задержка event loop пишется в лог вместе со стеком
+LOOP_LAG_WARN_MS = float(os.getenv("LOOP_LAG_WARN_MS", "200"))
+
+# Метрики Prometheus: GET /metrics на отдельном порту METRICS_PORT (0 — не поднимать),
+# у процесса N python -m promo_api — METRICS_PORT + N; на публичном порту webhook / promo API —
+# только если задан METRICS_TOKEN (Bearer для scrape).
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
@@ -1,19 +1,37 @@
 from __future__ import annotations
 
 import asyncio
+import base64
 import calendar
+import contextlib
+import contextvars
 import csv
+import functools
+import gzip
+import hashlib
 import io
+import itertools
+import json
 import logging
 import os
+import re
 import secrets
+import sqlite3
 import string
-from datetime import date, datetime
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from collections.abc import Awaitable, Callable
+from datetime import date, datetime, timedelta
 from zoneinfo import ZoneInfo
 
 import httpx
 from dotenv import load_dotenv
 
+import executor
+import metrics
+
 load_dotenv()
 
 logger = logging.getLogger(__name__)
@@ -25,9 +43,25 @@ _HTTP_TIMEOUT = httpx.Timeout(connect=10.0, read=30.0, write=10.0, pool=10.0)
 _EXECUTE_RETRIES = 3
 _EXECUTE_RETRY_DELAYS = (0.5, 1.0, 2.0)
 
+# Hrana-сессии: открытые стримы переиспользуются по baton вместо open/close на каждый запрос.
+# TURSO_STREAM_POOL=0 — старый режим (close в каждом pipeline).
+_STREAM_POOL_SIZE = int(os.getenv("TURSO_STREAM_POOL", "4"))
+# Сервер закрывает простаивающий стрим примерно через 10 с — отбрасываем раньше.
+_STREAM_IDLE_TIMEOUT = 8.0
+
+# Локальная реплика users/user_promos/settings для чтения (пусто — выключена).
+REPLICA_PATH = os.getenv("TURSO_REPLICA_PATH", "")
+REPLICA_SYNC_INTERVAL = float(os.getenv("TURSO_REPLICA_SYNC_INTERVAL", "60"))
+# Как часто подтягивать настройки, изменённые другими инстансами.
+SETTINGS_POLL_INTERVAL = float(os.getenv("SETTINGS_POLL_INTERVAL", "30"))
+# Сколько секунд помнить результат погашения по Idempotency-Key.
+PROMO_IDEMPOTENCY_TTL = float(os.getenv("PROMO_IDEMPOTENCY_TTL", "86400"))
+
 _client: httpx.AsyncClient | None = None
 
 _settings_cache: dict[str, str | None] = {}
+_settings_version = 0
+_settings_loaded = False
 _PROMO_TZ = ZoneInfo("Europe/Minsk")
 
 
@@ -35,6 +69,198 @@ class TursoError(Exception):
     """База Turso недоступна после повторных попыток."""
 
 
+# ── Метрики и трассировка запросов ─────────────────────────────────
+# Каждый _execute/_execute_batch: время с повторами, попытки, HTTP-статус, строки и вызывающая
+# функция. Сводка по отпечатку SQL — query_profile() (/dbprofile); запросы дольше
+# TURSO_SLOW_QUERY_MS — в лог database.slow; TURSO_TRACE=1 — каждый запрос в database.trace.
+SLOW_QUERY_MS = float(os.getenv("TURSO_SLOW_QUERY_MS", "500"))
+
+_slow_logger = logging.getLogger(f"{__name__}.slow")
+_trace_logger = logging.getLogger(f"{__name__}.trace")
+if os.getenv("TURSO_TRACE"):
+    _trace_logger.setLevel(logging.DEBUG)
+
+_QUERY_SECONDS = metrics.Histogram(
+    "turso_query_seconds", "Время запроса к Turso с повторами, по метке SQL", ("query",)
+)
+_QUERY_ERRORS = metrics.Counter(
+    "turso_query_errors_total", "Запросы к Turso, завершившиеся ошибкой", ("query",)
+)
+_QUERY_RETRIES = metrics.Counter(
+    "turso_query_retries_total",
+    "Повторы HTTP-запроса к Turso: timeout, stream_reset, stream_expired",
+    ("query", "reason"),
+)
+
+_SQL_LABEL_RE = re.compile(r"\b(?:FROM|INTO|UPDATE|TABLE|JOIN)\s+(\w+)", re.IGNORECASE)
+_SQL_LITERAL_RE = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_SQL_LIST_RE = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_SQL_ROWS_RE = re.compile(r"(\(\?, …\))(?:\s*,\s*\(\?, …\))+")
+
+
+@functools.lru_cache(maxsize=1024)
+def _sql_label(sql: str) -> str:
+    """Метка для метрик: команда и первая таблица — «select users», «update user_promos»."""
+    verb = sql.split(None, 1)[0].lower() if sql.strip() else ""
+    match = _SQL_LABEL_RE.search(sql)
+    return f"{verb} {match.group(1).lower()}" if match else verb
+
+
+@functools.lru_cache(maxsize=1024)
+def _fingerprint(sql: str) -> str:
+    """SQL без литералов и с IN (?, ?, …) одинаковой формы для любой длины списка."""
+    sql = " ".join(sql.split())
+    sql = _SQL_LITERAL_RE.sub("?", sql)
+    sql = _SQL_LIST_RE.sub("(?, …)", sql)
+    return _SQL_ROWS_RE.sub(r"\1, …", sql)
+
+
+class _QueryTrace:
+    """Текущий запрос: _post_pipeline дописывает попытки и HTTP-статус."""
+
+    __slots__ = ("label", "attempts", "status", "rows")
+
+    def __init__(self, label: str):
+        self.label = label
+        self.attempts = 0
+        self.status: int | None = None
+        self.rows = 0
+
+
+_current_query: contextvars.ContextVar[_QueryTrace | None] = contextvars.ContextVar(
+    "turso_query", default=None
+)
+
+# отпечаток SQL → счётчики с начала работы процесса
+_query_profile: dict[str, dict] = {}
+
+
+def _caller() -> str:
+    """
+    Кто вызвал _execute/_execute_batch: ближайшая публичная функция этого модуля
+    (через _read, _profile и т.п.) или функция другого модуля.
+    """
+    frame = sys._getframe(2)
+    name = "?"
+    while frame is not None:
+        name = frame.f_code.co_name
+        if not name.startswith("_") or frame.f_code.co_filename != __file__:
+            break
+        frame = frame.f_back
+    return name
+
+
+def _retried(reason: str) -> None:
+    trace = _current_query.get()
+    _QUERY_RETRIES.inc(trace.label if trace else "", reason)
+
+
+def _record_query(
+    fingerprint: str, caller: str, args_count: int, seconds: float, trace: _QueryTrace, failed: bool
+) -> None:
+    stats = _query_profile.get(fingerprint)
+    if stats is None:
+        stats = _query_profile[fingerprint] = {
+            "calls": 0,
+            "total_ms": 0.0,
+            "max_ms": 0.0,
+            "rows": 0,
+            "errors": 0,
+            "retries": 0,
+            "callers": {},
+        }
+    ms = seconds * 1000
+    stats["calls"] += 1
+    stats["total_ms"] += ms
+    stats["max_ms"] = max(stats["max_ms"], ms)
+    stats["rows"] += trace.rows
+    stats["errors"] += failed
+    stats["retries"] += max(0, trace.attempts - 1)
+    stats["callers"][caller] = stats["callers"].get(caller, 0) + 1
+
+    if SLOW_QUERY_MS and ms >= SLOW_QUERY_MS:
+        _slow_logger.warning(
+            "%.0f мс, попыток %s, HTTP %s, строк %s, аргументов %s%s, из %s: %s",
+            ms, trace.attempts, trace.status, trace.rows, args_count,
+            ", ошибка" if failed else "", caller, fingerprint,
+        )
+    elif _trace_logger.isEnabledFor(logging.DEBUG):
+        _trace_logger.debug(
+            "%.1f мс, попыток %s, HTTP %s, строк %s, аргументов %s, из %s: %s",
+            ms, trace.attempts, trace.status, trace.rows, args_count, caller, fingerprint,
+        )
+
+
+@contextlib.contextmanager
+def _traced(fingerprint: str, label: str, args_count: int, caller: str):
+    trace = _QueryTrace(label)
+    token = _current_query.set(trace)
+    started = time.perf_counter()
+    failed = False
+    try:
+        yield trace
+    except Exception:
+        failed = True
+        _QUERY_ERRORS.inc(label)
+        raise
+    finally:
+        _current_query.reset(token)
+        seconds = time.perf_counter() - started
+        _QUERY_SECONDS.observe(seconds, label)
+        _record_query(fingerprint, caller, args_count, seconds, trace, failed)
+
+
+def query_profile(limit: int = 10) -> list[dict]:
+    """Запросы с наибольшим суммарным временем с начала работы процесса (для /dbprofile)."""
+    top = sorted(_query_profile.items(), key=lambda item: item[1]["total_ms"], reverse=True)
+    return [{"sql": sql, **stats} for sql, stats in top[:limit]]
+
+
+def reset_query_profile() -> None:
+    _query_profile.clear()
+
+
+class _Stream:
+    """Серверный стрим Hrana: baton и base_url для следующего pipeline."""
+
+    __slots__ = ("baton", "base_url", "last_used")
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self) -> None:
+        self.baton: str | None = None
+        self.base_url: str | None = None
+        self.last_used = 0.0
+
+
+_idle_streams: list[_Stream] = []
+_streams_in_use = 0
+
+
+def _acquire_stream() -> _Stream | None:
+    """Свободный живой стрим из пула, новый (если есть место) или None — разовый запрос с close."""
+    global _streams_in_use
+    now = time.monotonic()
+    while _idle_streams:
+        stream = _idle_streams.pop()
+        if now - stream.last_used < _STREAM_IDLE_TIMEOUT:
+            _streams_in_use += 1
+            return stream
+    if _streams_in_use + len(_idle_streams) < _STREAM_POOL_SIZE:
+        _streams_in_use += 1
+        return _Stream()
+    return None
+
+
+def _release_stream(stream: _Stream, *, ok: bool) -> None:
+    global _streams_in_use
+    _streams_in_use -= 1
+    if ok and stream.baton is not None:
+        stream.last_used = time.monotonic()
+        _idle_streams.append(stream)
+
+
 def _get_client() -> httpx.AsyncClient:
     global _client
     if _client is None or _client.is_closed:
@@ -42,6 +268,15 @@ def _get_client() -> httpx.AsyncClient:
     return _client
 
 
+async def close() -> None:
+    """Закрывает HTTP-клиент и забывает стримы: перед fork и при остановке процесса."""
+    global _client
+    _idle_streams.clear()
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
 def _arg(value):
     if value is None:
         return {"type": "null"}
@@ -53,57 +288,520 @@ def _arg(value):
         return {"type": "text", "value": str(value)}
 
 
-async def _execute(sql: str, args=None) -> dict:
-    payload = {
-        "requests": [
-            {
-                "type": "execute",
-                "stmt": {"sql": sql, "args": [_arg(a) for a in (args or [])]},
-            },
-            {"type": "close"},
-        ]
-    }
-    headers = {
+def _stmt(sql: str, args=None) -> dict:
+    return {"sql": sql, "args": [_arg(a) for a in (args or [])]}
+
+
+def _is_read(sql: str) -> bool:
+    """Запрос без побочных эффектов: его можно повторить, не зная, выполнился ли первый."""
+    return sql.lstrip()[:6].upper() in ("SELECT", "PRAGMA")
+
+
+def _headers() -> dict:
+    return {
         "Authorization": f"Bearer {TURSO_TOKEN}",
         "Content-Type": "application/json",
     }
+
+
+def _is_stream_error(response: httpx.Response) -> bool:
+    """4xx на запрос с baton (кроме 401/403/429): стрим истёк или закрыт, запрос не выполнялся."""
+    return 400 <= response.status_code < 500 and response.status_code not in (401, 403, 429)
+
+
+# Фоновые close брошенных стримов — ссылки держим, чтобы задачи не собрал GC.
+_closing_streams: set[asyncio.Task] = set()
+
+
+async def _close_baton(base_url: str, baton: str) -> None:
+    try:
+        await _get_client().post(
+            f"{base_url}/v2/pipeline",
+            headers=_headers(),
+            json={"baton": baton, "requests": [{"type": "close"}]},
+        )
+    except (httpx.HTTPError, RuntimeError):
+        pass
+
+
+def _drop_stream(stream: _Stream) -> None:
+    """Стрим в неизвестном состоянии: close его baton в фоне (best effort), дальше — новый стрим."""
+    task = asyncio.create_task(_close_baton(stream.base_url or TURSO_URL, stream.baton))
+    _closing_streams.add(task)
+    task.add_done_callback(_closing_streams.discard)
+    stream.reset()
+
+
+async def _pipeline(requests: list[dict], *, idempotent: bool) -> list[dict]:
+    """
+    Один POST /v2/pipeline; возвращает ответы на requests (без финального close).
+    idempotent — только чтения: их можно повторить после таймаута или 5xx.
+    """
+    stream = _acquire_stream()
+    if stream is None:
+        return await _post_pipeline(requests, None, idempotent)
+    try:
+        responses = await _post_pipeline(requests, stream, idempotent)
+    except BaseException:
+        _release_stream(stream, ok=False)
+        raise
+    _release_stream(stream, ok=True)
+    return responses
+
+
+async def _post_pipeline(
+    requests: list[dict], stream: _Stream | None, idempotent: bool
+) -> list[dict]:
+    """
+    Повторы: запрос, не дошедший до сервера (ошибка соединения), — всегда; истёкший baton —
+    в новом стриме. Таймаут ответа и 5xx повторяются только для чтений: запись могла
+    уже примениться, поэтому для неё — TursoError.
+    """
+    payload: dict = {"requests": list(requests)}
+    if stream is None:
+        payload["requests"].append({"type": "close"})
+    elif stream.baton is not None:
+        payload["baton"] = stream.baton
+    base_url = (stream.base_url if stream is not None else None) or TURSO_URL
+    trace = _current_query.get()
     last_exc: Exception | None = None
     for attempt in range(_EXECUTE_RETRIES):
+        if trace is not None:
+            trace.attempts += 1
         try:
             r = await _get_client().post(
-                f"{TURSO_URL}/v2/pipeline",
-                headers=headers,
+                f"{base_url}/v2/pipeline",
+                headers=_headers(),
                 json=payload,
             )
+            if trace is not None:
+                trace.status = r.status_code
             r.raise_for_status()
-            return r.json()["results"][0]["response"]["result"]
-        except (httpx.TimeoutException, httpx.ConnectError) as exc:
+            data = r.json()
+            break
+        except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout) as exc:
+            # Запрос до сервера не дошёл — повтор безопасен и для записи, стрим не тронут.
             last_exc = exc
-            if attempt < _EXECUTE_RETRIES - 1:
-                delay = _EXECUTE_RETRY_DELAYS[attempt]
-                logger.warning(
-                    "Turso timeout (попытка %s/%s), повтор через %.1f с: %s",
-                    attempt + 1,
-                    _EXECUTE_RETRIES,
-                    delay,
-                    exc,
-                )
-                await asyncio.sleep(delay)
+        except httpx.TimeoutException as exc:
+            last_exc = exc
+            if stream is not None and stream.baton is not None:
+                # Состояние стрима после таймаута неизвестно — его больше не используем.
+                _drop_stream(stream)
+                if idempotent:
+                    _retried("stream_reset")
+                    return await _post_pipeline(requests, stream, idempotent)
+            if not idempotent:
+                raise TursoError("Turso не ответила (таймаут), запись могла выполниться") from exc
         except httpx.HTTPStatusError as exc:
+            if stream is not None and stream.baton is not None:
+                if _is_stream_error(exc.response):
+                    logger.info(
+                        "Turso stream expired (HTTP %s), reconnecting", exc.response.status_code
+                    )
+                    _retried("stream_expired")
+                    stream.reset()
+                    return await _post_pipeline(requests, stream, idempotent)
+                _drop_stream(stream)
+                if idempotent:
+                    _retried("stream_reset")
+                    return await _post_pipeline(requests, stream, idempotent)
             raise TursoError(f"Turso HTTP {exc.response.status_code}") from exc
-    raise TursoError("Turso недоступна (таймаут)") from last_exc
+        if attempt < _EXECUTE_RETRIES - 1:
+            delay = _EXECUTE_RETRY_DELAYS[attempt]
+            _retried("timeout")
+            logger.warning(
+                "Turso timeout (попытка %s/%s), повтор через %.1f с: %s",
+                attempt + 1,
+                _EXECUTE_RETRIES,
+                delay,
+                last_exc,
+            )
+            await asyncio.sleep(delay)
+    else:
+        raise TursoError("Turso недоступна (таймаут)") from last_exc
+
+    if stream is not None:
+        stream.baton = data.get("baton")
+        stream.base_url = data.get("base_url") or stream.base_url
+    results = data["results"][: len(requests)]
+    for item in results:
+        if item.get("type") == "error":
+            raise TursoError(f"Turso: {item['error'].get('message')}")
+    return [item["response"] for item in results]
+
+
+async def _execute(sql: str, args=None) -> dict:
+    with _traced(_fingerprint(sql), _sql_label(sql), len(args or ()), _caller()) as trace:
+        responses = await _pipeline(
+            [{"type": "execute", "stmt": _stmt(sql, args)}], idempotent=_is_read(sql)
+        )
+        trace.rows = len(responses[0]["result"]["rows"])
+    return responses[0]["result"]
+
+
+async def _execute_batch(statements: list[tuple[str, list | None]]) -> list[dict]:
+    """
+    Несколько запросов за один round trip, в одной транзакции.
+    statements: [(sql, args), ...]; возвращает result для каждого запроса по порядку.
+    Ошибка любого запроса откатывает всю пачку и поднимает TursoError.
+    """
+    if not statements:
+        return []
+    # BEGIN, запросы цепочкой «выполнять, если предыдущий шаг ок», COMMIT, ROLLBACK при сбое.
+    steps = [{"stmt": _stmt("BEGIN")}]
+    for sql, args in statements:
+        steps.append({
+            "stmt": _stmt(sql, args),
+            "condition": {"type": "ok", "step": len(steps) - 1},
+        })
+    commit_step = len(steps)
+    steps.append({
+        "stmt": _stmt("COMMIT"),
+        "condition": {"type": "ok", "step": commit_step - 1},
+    })
+    steps.append({
+        "stmt": _stmt("ROLLBACK"),
+        "condition": {"type": "not", "cond": {"type": "ok", "step": commit_step}},
+    })
+
+    fingerprint = "BATCH " + "; ".join(_fingerprint(sql) for sql, _ in statements)
+    args_count = sum(len(args or ()) for _, args in statements)
+    label = f"batch {_sql_label(statements[0][0])}"
+    with _traced(fingerprint, label, args_count, _caller()) as trace:
+        responses = await _pipeline(
+            [{"type": "batch", "batch": {"steps": steps}}],
+            idempotent=all(_is_read(sql) for sql, _ in statements),
+        )
+        result = responses[0]["result"]
+        for error in result["step_errors"][: commit_step + 1]:
+            if error is not None:
+                raise TursoError(f"Turso batch: {error.get('message')}")
+        trace.rows = sum(len(r["rows"]) for r in result["step_results"][1:commit_step] if r)
+    return result["step_results"][1:commit_step]
+
+
+# Значения Hrana по типу ячейки: integer приходит строкой, blob — base64.
+_DECODERS = {
+    "null": lambda cell: None,
+    "integer": lambda cell: int(cell["value"]),
+    "float": lambda cell: float(cell["value"]),
+    "text": lambda cell: cell["value"],
+    "blob": lambda cell: base64.b64decode(cell["base64"]),
+}
+
+
+def _tuples(result: dict) -> list[tuple]:
+    """Строки результата как кортежи типизированных значений в порядке колонок SELECT."""
+    decoders = _DECODERS
+    return [tuple(decoders[cell["type"]](cell) for cell in row) for row in result["rows"]]
 
 
 def _rows(result: dict) -> list[dict]:
+    """То же, что _tuples, но словарями по имени колонки."""
     cols = [c["name"] for c in result["cols"]]
-    return [
-        {cols[i]: (cell["value"] if cell["type"] != "null" else None) for i, cell in enumerate(row)}
-        for row in result["rows"]
+    return [dict(zip(cols, row)) for row in _tuples(result)]
+
+
+# ── Локальная реплика ──────────────────────────────────────────────
+# Чтения профиля, промокода и настроек обслуживаются из SQLite-файла; запись идёт в Turso
+# и сразу повторяется в реплике. При старте реплика перезаливается целиком, дальше раз
+# в REPLICA_SYNC_INTERVAL подтягиваются только строки, изменённые с прошлого раза (по version),
+# в том числе другими инстансами. До первой успешной синхронизации читаем из Turso.
+
+_REPLICA_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY,
+        phone TEXT,
+        giveaway_number INTEGER
+    );
+    CREATE TABLE IF NOT EXISTS user_promos (
+        user_id INTEGER PRIMARY KEY,
+        code TEXT NOT NULL UNIQUE,
+        active INTEGER NOT NULL DEFAULT 1,
+        created_at TEXT
+    );
+    CREATE TABLE IF NOT EXISTS settings (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    );
+"""
+
+_REPLICA_TABLES = {
+    "users": ("user_id", "phone", "giveaway_number"),
+    "user_promos": ("user_id", "code", "active", "created_at"),
+    "settings": ("key", "value"),
+}
+
+_replica: sqlite3.Connection | None = None
+_replica_ready = False
+# Наибольшая version, уже перенесённая в реплику, по таблицам; пусто — нужна полная перезаливка.
+_replica_versions: dict[str, int] = {}
+# Растёт при каждой неудачной записи в реплику.
+_replica_generation = 0
+
+
+def replica_enabled() -> bool:
+    return bool(REPLICA_PATH)
+
+
+def _get_replica() -> sqlite3.Connection:
+    global _replica
+    if _replica is None:
+        # timeout=0: пока идёт первая перезаливка (в потоке), запись не ждёт блокировку, а сразу
+        # уходит в fallback; последующие синхронизации пишут через это же соединение.
+        _replica = sqlite3.connect(REPLICA_PATH, isolation_level=None, timeout=0)
+        _replica.row_factory = sqlite3.Row
+        _replica.execute("PRAGMA journal_mode=WAL")
+        _replica.executescript(_REPLICA_SCHEMA)
+    return _replica
+
+
+def _reload_replica(snapshot: list[list[tuple]]) -> None:
+    """
+    Перезаливка в пуле потоков через отдельное соединение: благодаря WAL чтения из loop
+    до COMMIT видят прежний снимок, а не пустые таблицы.
+    """
+    conn = sqlite3.connect(REPLICA_PATH, isolation_level=None)
+    try:
+        conn.execute("BEGIN")
+        try:
+            for (table, cols), rows in zip(_REPLICA_TABLES.items(), snapshot):
+                conn.execute(f"DELETE FROM {table}")
+                conn.executemany(
+                    f"INSERT INTO {table} ({', '.join(cols)}) VALUES ({', '.join('?' * len(cols))})",
+                    rows,
+                )
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+
+
+def _apply_replica_changes(changes: list[list[tuple]]) -> None:
+    """
+    Изменённые строки — в loop, через то же соединение, что и _replica_write: их обычно
+    единицы, и запись в реплику не упирается в блокировку параллельной транзакции.
+    """
+    conn = _get_replica()
+    conn.execute("BEGIN")
+    try:
+        for (table, cols), rows in zip(_REPLICA_TABLES.items(), changes):
+            conn.executemany(
+                f"INSERT OR REPLACE INTO {table} ({', '.join(cols)})"
+                f" VALUES ({', '.join('?' * len(cols))})",
+                rows,
+            )
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+
+async def sync_replica() -> None:
+    """
+    Первый раз — полная перезаливка снимком из Turso (одна транзакция на обеих сторонах),
+    дальше — только строки с version больше уже перенесённой.
+    """
+    global _replica_ready
+    full = not _replica_versions
+    since = {table: _replica_versions.get(table, -1) for table in _REPLICA_TABLES}
+    results = await _execute_batch([
+        (f"SELECT {', '.join(cols)}, version FROM {table} WHERE version > ?", [since[table]])
+        for table, cols in _REPLICA_TABLES.items()
+    ])
+    rows = [_tuples(result) for result in results]
+    _get_replica()
+    generation = _replica_generation
+    changes = [[row[:-1] for row in table_rows] for table_rows in rows]
+    if full:
+        await executor.run_blocking(_reload_replica, changes)
+    else:
+        _apply_replica_changes(changes)
+    for table, table_rows in zip(_REPLICA_TABLES, rows):
+        _replica_versions[table] = max((row[-1] for row in table_rows), default=since[table])
+    # Запись в реплику, сорвавшаяся во время перезаливки, в снимок не попала; её строка
+    # придёт со следующей синхронизацией (version в Turso уже увеличен).
+    if generation == _replica_generation:
+        _replica_ready = True
+
+
+async def run_replica_sync() -> None:
+    """Фоновая задача: синхронизирует реплику каждые REPLICA_SYNC_INTERVAL секунд."""
+    while True:
+        await asyncio.sleep(REPLICA_SYNC_INTERVAL)
+        try:
+            await sync_replica()
+        except (TursoError, sqlite3.Error) as e:
+            logger.warning("replica sync failed, serving stale reads: %s", e)
+
+
+async def _read(sql: str, args=None) -> list[dict]:
+    """SELECT по таблицам реплики: локально, если реплика готова, иначе из Turso."""
+    if _replica_ready:
+        return [dict(row) for row in _get_replica().execute(sql, args or [])]
+    return _rows(await _execute(sql, args))
+
+
+def _replica_write(sql: str, args=None) -> None:
+    """Повторяет уже применённую в Turso запись в реплике; при сбое — читаем из Turso до синхронизации."""
+    global _replica_ready, _replica_generation
+    if not _replica_ready:
+        return
+    try:
+        _get_replica().execute(sql, args or [])
+    except sqlite3.Error as e:
+        logger.warning("replica write failed, falling back to Turso reads: %s", e)
+        _replica_ready = False
+        _replica_generation += 1
+
+
+def _replica_upsert(table: str, row: dict) -> None:
+    cols = _REPLICA_TABLES[table]
+    _replica_write(
+        f"INSERT OR REPLACE INTO {table} ({', '.join(cols)}) VALUES ({', '.join('?' * len(cols))})",
+        [row[c] for c in cols],
+    )
+
+
+# ── Кэш профилей ───────────────────────────────────────────────────
+# Профиль пользователя (есть ли в базе, телефон, номер розыгрыша, промокод) читается одним
+# запросом и живёт в памяти до TTL; функции записи сбрасывают запись сразу. Сброс — только
+# в своём процессе: погашение через python -m promo_api сюда не доходит, поэтому промокод
+# из кэша отдаётся не старше _PROFILE_PROMO_TTL.
+
+_PROFILE_CACHE_SIZE = 10_000
+_PROFILE_CACHE_TTL = 300.0
+_PROFILE_PROMO_TTL = 30.0
+
+MISSING = object()
+
+
+class TTLCache:
+    """
+    LRU с ограничением размера и временем жизни записей; считает попадания и промахи.
+    get возвращает MISSING, если записи нет или она устарела (старше max_age, если задан).
+
+    Чтение из базы и set разделены await: запись, сброшенная (pop) за это время, не должна
+    вернуться в кэш старым значением. Поэтому перед чтением берём generation() и передаём
+    его в set — значение не кэшируется, если ключ сбрасывали после этой отметки.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict = OrderedDict()
+        self._generation = 0
+        # Ключ → generation последнего pop; вытесненные старые отметки — не выше _popped_floor.
+        self._popped: OrderedDict = OrderedDict()
+        self._popped_floor = 0
+
+    def get(self, key, max_age: float | None = None):
+        item = self._data.get(key)
+        now = time.monotonic()
+        if item is None or now - item[0] > min(self.ttl, max_age or self.ttl):
+            self.misses += 1
+            return MISSING
+        self._data.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def generation(self) -> int:
+        return self._generation
+
+    def set(self, key, value, generation: int | None = None) -> None:
+        if generation is not None and self._popped.get(key, self._popped_floor) > generation:
+            return
+        self._data[key] = (time.monotonic(), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key) -> None:
+        self._data.pop(key, None)
+        self._generation += 1
+        self._popped[key] = self._generation
+        self._popped.move_to_end(key)
+        while len(self._popped) > self.maxsize:
+            _, self._popped_floor = self._popped.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {"size": len(self._data), "hits": self.hits, "misses": self.misses}
+
+
+_profile_cache = TTLCache(_PROFILE_CACHE_SIZE, _PROFILE_CACHE_TTL)
+metrics.register_cache("profile", _profile_cache)
+
+
+def profile_cache_stats() -> dict:
+    return _profile_cache.stats()
+
+
+async def _profile(user_id: int, max_age: float | None = None) -> dict:
+    profile = _profile_cache.get(user_id, max_age)
+    if profile is not MISSING:
+        return profile
+    generation = _profile_cache.generation()
+    rows = await _read(
+        "SELECT u.user_id AS exists_id, u.phone, u.giveaway_number,"
+        " p.user_id, p.code, p.active, p.created_at"
+        " FROM (SELECT ? AS uid) q"
+        " LEFT JOIN users u ON u.user_id = q.uid"
+        " LEFT JOIN user_promos p ON p.user_id = q.uid",
+        [user_id],
+    )
+    row = rows[0]
+    profile = {
+        "exists": row["exists_id"] is not None,
+        "phone": row["phone"],
+        "giveaway_number": row["giveaway_number"],
+        "promo": _promo_row(row) if row["code"] is not None else None,
+    }
+    _profile_cache.set(user_id, profile, generation)
+    return profile
+
+
+# ── Схема ──────────────────────────────────────────────────────────
+async def _backfill_phone_keys():
+    """Заполняет phone_digits/phone_last9 для строк, сохранённых до появления колонок."""
+    result = await _execute(
+        "SELECT id, phone FROM users WHERE phone IS NOT NULL AND phone_digits IS NULL"
+    )
+    updates = [
+        ("UPDATE users SET phone_digits = ?, phone_last9 = ? WHERE id = ?",
+         [*_phone_keys(phone), row_id])
+        for row_id, phone in _tuples(result)
     ]
+    for i in range(0, len(updates), 500):
+        await _execute_batch(updates[i:i + 500])
 
 
-async def init_db():
-    await _execute("""
+async def _backfill_promo_valid_until():
+    """Заполняет valid_until для промокодов, выданных до появления колонки."""
+    result = await _execute(
+        "SELECT user_id, created_at FROM user_promos"
+        " WHERE valid_until IS NULL AND created_at IS NOT NULL"
+    )
+    updates = [
+        ("UPDATE user_promos SET valid_until = ? WHERE user_id = ?",
+         [_promo_valid_until(created_at), user_id])
+        for user_id, created_at in _tuples(result)
+    ]
+    for i in range(0, len(updates), 500):
+        await _execute_batch(updates[i:i + 500])
+
+
+# Упорядоченные миграции: (версия, SQL или backfill). Применённые версии хранятся
+# в schema_migrations; на старте — один запрос за текущей версией, идущие подряд
+# SQL-миграции — одной транзакцией. ADD COLUMN пропускается, если колонка уже есть
+# (база могла дорасти до учёта миграций). Backfill (заполнение старых строк кодом)
+# идёт отдельно, и его версия пишется только после успешного прохода.
+_MIGRATIONS: list[tuple[int, list[str] | Callable[[], Awaitable[None]]]] = [
+    (1, [
+        """
         CREATE TABLE IF NOT EXISTS users (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER UNIQUE NOT NULL,
@@ -114,14 +812,14 @@ async def init_db():
             joined_at TEXT,
             giveaway_number INTEGER
         )
-    """)
-    await _execute("""
+        """,
+        """
         CREATE TABLE IF NOT EXISTS settings (
             key TEXT PRIMARY KEY,
             value TEXT
         )
-    """)
-    await _execute("""
+        """,
+        """
         CREATE TABLE IF NOT EXISTS reviews (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER,
@@ -131,16 +829,252 @@ async def init_db():
             text TEXT,
             created_at TEXT
         )
-    """)
-    await _execute("""
+        """,
+        """
         CREATE TABLE IF NOT EXISTS user_promos (
             user_id INTEGER PRIMARY KEY,
             code TEXT NOT NULL UNIQUE,
             active INTEGER NOT NULL DEFAULT 1,
             created_at TEXT
         )
-    """)
-    await assign_missing_giveaway_numbers()
+        """,
+    ]),
+    # Индексированный поиск по телефону; значения для старых строк — миграция 11.
+    (2, [
+        "ALTER TABLE users ADD COLUMN phone_digits TEXT",
+        "ALTER TABLE users ADD COLUMN phone_last9 TEXT",
+        "CREATE INDEX IF NOT EXISTS idx_users_phone_digits ON users(phone_digits)",
+        "CREATE INDEX IF NOT EXISTS idx_users_phone_last9 ON users(phone_last9)",
+    ]),
+    # Уникальные номера розыгрыша: повторы (после старых гонок в add_user) сбрасываются
+    # у более поздних регистраций, пустые номера выдаются по порядку id после максимума.
+    # Каждая смена уже выданного номера (старый → новый) остаётся в giveaway_number_changes;
+    # бот при старте отправляет неотправленные записи админам.
+    (3, [
+        """
+        CREATE TABLE IF NOT EXISTS giveaway_number_changes (
+            user_id INTEGER NOT NULL,
+            old_number INTEGER NOT NULL,
+            new_number INTEGER,
+            reported_at TEXT
+        )
+        """,
+        "INSERT INTO giveaway_number_changes (user_id, old_number)"
+        " SELECT user_id, giveaway_number FROM users"
+        " WHERE giveaway_number IS NOT NULL AND id NOT IN ("
+        "SELECT MIN(id) FROM users WHERE giveaway_number IS NOT NULL GROUP BY giveaway_number)",
+        "UPDATE users SET giveaway_number = NULL"
+        " WHERE giveaway_number IS NOT NULL AND id NOT IN ("
+        "SELECT MIN(id) FROM users WHERE giveaway_number IS NOT NULL GROUP BY giveaway_number)",
+        "UPDATE users SET giveaway_number = numbered.num FROM ("
+        "SELECT id, (SELECT COALESCE(MAX(giveaway_number), 0) FROM users)"
+        " + ROW_NUMBER() OVER (ORDER BY id) AS num"
+        " FROM users WHERE giveaway_number IS NULL) AS numbered"
+        " WHERE users.id = numbered.id",
+        "UPDATE giveaway_number_changes SET new_number = ("
+        "SELECT giveaway_number FROM users WHERE users.user_id = giveaway_number_changes.user_id)"
+        " WHERE new_number IS NULL",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_users_giveaway_number ON users(giveaway_number)",
+    ]),
+    # Рассылки: задание и статус каждого получателя — для возобновления после рестарта.
+    (4, [
+        """
+        CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'running',
+            total INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            status_chat_id INTEGER,
+            status_message_id INTEGER,
+            created_at TEXT,
+            finished_at TEXT
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS broadcast_recipients (
+            job_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            PRIMARY KEY (job_id, user_id)
+        ) WITHOUT ROWID
+        """,
+    ]),
+    # Недоставляемые чаты (бот заблокирован, аккаунт удалён) исключаются из рассылок.
+    (5, [
+        "ALTER TABLE users ADD COLUMN blocked_at TEXT",
+        "ALTER TABLE users ADD COLUMN undeliverable TEXT",
+    ]),
+    # Версия настройки растёт при каждой записи — инстансы подтягивают изменения по version > ?.
+    (6, [
+        "ALTER TABLE settings ADD COLUMN version INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE settings ADD COLUMN updated_at TEXT",
+        "CREATE INDEX IF NOT EXISTS idx_settings_version ON settings(version)",
+    ]),
+    # Последний день действия промокода (YYYY-MM-DD) — погашение проверяет срок в том же UPDATE.
+    # Значения для старых строк — миграция 12.
+    (7, [
+        "ALTER TABLE user_promos ADD COLUMN valid_until TEXT",
+    ]),
+    # Успешные погашения по Idempotency-Key: повтор запроса после таймаута получает тот же ответ.
+    (8, [
+        """
+        CREATE TABLE IF NOT EXISTS promo_idempotency (
+            key TEXT PRIMARY KEY,
+            code TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            discount_percent INTEGER NOT NULL,
+            created_at TEXT NOT NULL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_promo_idempotency_created_at"
+        " ON promo_idempotency(created_at)",
+    ]),
+    # Клиенты API промокодов: свой секрет (хранится только sha256), разрешённые эндпоинты,
+    # своя скидка. version растёт при каждой записи — promo_api подтягивает изменения по version > ?.
+    (9, [
+        """
+        CREATE TABLE IF NOT EXISTS api_clients (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL UNIQUE,
+            secret_hash TEXT NOT NULL UNIQUE,
+            endpoints TEXT,
+            discount_percent INTEGER,
+            active INTEGER NOT NULL DEFAULT 1,
+            version INTEGER NOT NULL DEFAULT 0,
+            created_at TEXT
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_api_clients_version ON api_clients(version)",
+    ]),
+    # Версия строк users/user_promos — реплика подтягивает только изменённые (version > ?).
+    # Её увеличивают триггеры при записи реплицируемых колонок, из какой бы функции та ни шла.
+    (10, [
+        "ALTER TABLE users ADD COLUMN version INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE user_promos ADD COLUMN version INTEGER NOT NULL DEFAULT 0",
+        "CREATE INDEX IF NOT EXISTS idx_users_version ON users(version)",
+        "CREATE INDEX IF NOT EXISTS idx_user_promos_version ON user_promos(version)",
+        """
+        CREATE TRIGGER IF NOT EXISTS users_version_insert AFTER INSERT ON users
+        BEGIN
+            UPDATE users SET version = (SELECT MAX(version) FROM users) + 1 WHERE id = NEW.id;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS users_version_update
+        AFTER UPDATE OF phone, giveaway_number ON users
+        BEGIN
+            UPDATE users SET version = (SELECT MAX(version) FROM users) + 1 WHERE id = NEW.id;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS user_promos_version_insert AFTER INSERT ON user_promos
+        BEGIN
+            UPDATE user_promos SET version = (SELECT MAX(version) FROM user_promos) + 1
+            WHERE user_id = NEW.user_id;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS user_promos_version_update
+        AFTER UPDATE OF code, active, created_at ON user_promos
+        BEGIN
+            UPDATE user_promos SET version = (SELECT MAX(version) FROM user_promos) + 1
+            WHERE user_id = NEW.user_id;
+        END
+        """,
+    ]),
+    (11, _backfill_phone_keys),
+    (12, _backfill_promo_valid_until),
+    # Поминутная нагрузка клиентов API от каждого процесса (бот, воркеры python -m promo_api):
+    # /apiclient суммирует её по всем процессам. latency — JSON-массив счётчиков по корзинам.
+    (13, [
+        """
+        CREATE TABLE IF NOT EXISTS api_client_usage (
+            client TEXT NOT NULL,
+            minute TEXT NOT NULL,
+            process TEXT NOT NULL,
+            requests INTEGER NOT NULL,
+            errors INTEGER NOT NULL,
+            latency TEXT NOT NULL,
+            PRIMARY KEY (client, minute, process)
+        ) WITHOUT ROWID
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_api_client_usage_minute ON api_client_usage(minute)",
+    ]),
+]
+
+_ADD_COLUMN_RE = re.compile(r"\s*ALTER TABLE (\w+) ADD COLUMN (\w+)", re.IGNORECASE)
+
+
+async def _schema_version() -> int:
+    _, result = await _execute_batch([
+        (
+            "CREATE TABLE IF NOT EXISTS schema_migrations"
+            " (version INTEGER PRIMARY KEY, applied_at TEXT)",
+            None,
+        ),
+        ("SELECT COALESCE(MAX(version), 0) AS version FROM schema_migrations", None),
+    ])
+    return _tuples(result)[0][0]
+
+
+async def _apply_sql_migrations(pending: list[tuple[int, list[str]]]):
+    statements = [sql for _, stmts in pending for sql in stmts]
+
+    columns: dict[str, set[str]] = {}
+    for match in filter(None, map(_ADD_COLUMN_RE.match, statements)):
+        table = match[1]
+        if table not in columns:
+            result = await _execute(f"PRAGMA table_info({table})")
+            columns[table] = {row["name"] for row in _rows(result)}
+
+    batch = []
+    for sql in statements:
+        match = _ADD_COLUMN_RE.match(sql)
+        if match and match[2] in columns[match[1]]:
+            continue
+        batch.append((sql, None))
+    now = datetime.now().isoformat(timespec="seconds")
+    batch += [
+        ("INSERT INTO schema_migrations (version, applied_at) VALUES (?, ?)", [version, now])
+        for version, _ in pending
+    ]
+    await _execute_batch(batch)
+
+
+async def _apply_migrations(current: int):
+    pending = [(version, step) for version, step in _MIGRATIONS if version > current]
+    for is_backfill, group in itertools.groupby(pending, key=lambda m: callable(m[1])):
+        if not is_backfill:
+            await _apply_sql_migrations(list(group))
+            continue
+        for version, backfill in group:
+            # Прерванный backfill (сбой, рестарт) повторится: версия ещё не записана,
+            # а сам он трогает только строки с NULL.
+            await backfill()
+            await _execute(
+                "INSERT INTO schema_migrations (version, applied_at) VALUES (?, ?)",
+                [version, datetime.now().isoformat(timespec="seconds")],
+            )
+    logger.info("Схема БД обновлена: версия %s → %s", current, pending[-1][0])
+
+
+async def migrate():
+    """Доводит схему до последней версии (без настроек и реплики — для promo_api)."""
+    current = await _schema_version()
+    if current < _MIGRATIONS[-1][0]:
+        await _apply_migrations(current)
+
+
+async def init_db():
+    await migrate()
+    await load_settings()
+    if replica_enabled():
+        try:
+            await sync_replica()
+        except (TursoError, sqlite3.Error) as e:
+            logger.warning("initial replica sync failed, reading from Turso: %s", e)
 
 
 _PROMO_ALPHABET = string.ascii_uppercase + string.digits
@@ -149,7 +1083,7 @@ _PROMO_CODE_BODY_LEN = 8
 
 
 class PromoRedeemError(Exception):
-    """invalid_format | not_found | already_used | expired"""
+    """invalid_format | not_found | already_used | expired | idempotency_key_reused"""
 
     def __init__(self, code: str):
         self.code = code
@@ -168,6 +1102,32 @@ def promo_valid_until_date(created_at: str) -> date:
     return date(year, month, min(issued.day, last_day))
 
 
+def _promo_valid_until(created_at: str) -> str:
+    """valid_until для user_promos: ISO-дата сравнивается строкой."""
+    return promo_valid_until_date(created_at).isoformat()
+
+
+# Код в срок: по valid_until, а у строк, до которых ещё не дошёл _backfill_promo_valid_until, —
+# по дате выдачи. Аргументы — _promo_term_args().
+_PROMO_IN_TERM_SQL = (
+    "(valid_until >= ? OR (valid_until IS NULL AND (created_at IS NULL OR created_at >= ?)))"
+)
+
+
+def _promo_term_args(today: date) -> list[str]:
+    """[сегодня, самая ранняя дата выдачи, код с которой ещё действует сегодня]."""
+    issued = today - timedelta(days=31)
+    while promo_valid_until_date(issued.isoformat()) < today:
+        issued += timedelta(days=1)
+    return [today.isoformat(), issued.isoformat()]
+
+
+def _effective_valid_until(valid_until: str | None, created_at: str | None) -> str | None:
+    if valid_until is None and created_at:
+        return _promo_valid_until(created_at)
+    return valid_until
+
+
 def format_promo_valid_until(created_at: str) -> str:
     v = promo_valid_until_date(created_at)
     return f"{v.day:02d}.{v.month:02d}.{v.year}"
@@ -192,13 +1152,24 @@ def normalize_promo_code(code: str) -> str | None:
     return normalized
 
 
-async def _new_unique_promo_code() -> str:
-    for _ in range(64):
-        code = "NR-" + "".join(secrets.choice(_PROMO_ALPHABET) for _ in range(8))
-        result = await _execute("SELECT 1 FROM user_promos WHERE code = ?", [code])
-        if not _rows(result):
-            return code
-    raise RuntimeError("не удалось сгенерировать уникальный промокод")
+_PROMO_CODE_ATTEMPTS = 64
+
+
+def _random_promo_code() -> str:
+    return _PROMO_CODE_PREFIX + "".join(
+        secrets.choice(_PROMO_ALPHABET) for _ in range(_PROMO_CODE_BODY_LEN)
+    )
+
+
+def _promo_row(row: dict) -> dict:
+    av = row["active"]
+    active = bool(av) if av is not None else True
+    return {
+        "user_id": row["user_id"],
+        "code": row["code"],
+        "active": active,
+        "created_at": row["created_at"],
+    }
 
 
 async def get_user_id_by_promo_code(code: str) -> int | None:
@@ -213,7 +1184,7 @@ async def get_user_id_by_promo_code(code: str) -> int | None:
     rows = _rows(result)
     if not rows:
         return None
-    return int(rows[0]["user_id"])
+    return rows[0]["user_id"]
 
 
 def normalize_phone_digits(phone: str) -> str:
@@ -232,57 +1203,68 @@ def phones_match(stored: str, query: str) -> bool:
     return False
 
 
+def _phone_keys(phone: str | None) -> tuple[str | None, str | None]:
+    """(phone_digits, phone_last9) для индексированного поиска — та же логика, что phones_match."""
+    if phone is None:
+        return None, None
+    digits = normalize_phone_digits(phone)
+    return digits, (digits[-9:] if len(digits) >= 9 else None)
+
+
 async def get_user_id_by_phone(phone: str) -> int | None:
     """Находит user_id по номеру телефона (форматы +375…, пробелы, дефисы)."""
-    query = phone.strip()
-    if len(normalize_phone_digits(query)) < 7:
+    digits, last9 = _phone_keys(phone.strip())
+    if len(digits) < 7:
         return None
-    result = await _execute(
-        "SELECT user_id, phone FROM users WHERE phone IS NOT NULL AND TRIM(phone) != ''"
-    )
-    for row in _rows(result):
-        stored = row.get("phone")
-        if stored and phones_match(stored, query):
-            return int(row["user_id"])
-    return None
+    if last9 is None:
+        result = await _execute(
+            "SELECT user_id FROM users WHERE phone_digits = ? ORDER BY id LIMIT 1",
+            [digits],
+        )
+    else:
+        result = await _execute(
+            "SELECT user_id FROM users WHERE phone_digits = ? OR phone_last9 = ?"
+            " ORDER BY id LIMIT 1",
+            [digits, last9],
+        )
+    rows = _tuples(result)
+    return rows[0][0] if rows else None
 
 
 async def get_user_promo(user_id: int) -> dict | None:
-    result = await _execute(
-        "SELECT user_id, code, active, created_at FROM user_promos WHERE user_id = ?",
-        [user_id],
-    )
-    rows = _rows(result)
-    if not rows:
-        return None
-    row = rows[0]
-    av = row["active"]
-    active = bool(int(av)) if av is not None else True
-    return {
-        "user_id": int(row["user_id"]),
-        "code": row["code"],
-        "active": active,
-        "created_at": row["created_at"],
-    }
+    return (await _profile(user_id, _PROFILE_PROMO_TTL))["promo"]
 
 
 async def issue_user_promo(user_id: int) -> dict:
     """Один промокод на пользователя: если уже есть — возвращаем существующий (в т.ч. отозванный; новый не создаём)."""
-    existing = await get_user_promo(user_id)
-    if existing:
-        return existing
-    phone = await get_phone(user_id)
-    if not phone:
-        raise ValueError("промокод выдаётся только при сохранённом номере телефона")
-    code = await _new_unique_promo_code()
-    now = datetime.now().isoformat(timespec="seconds")
-    await _execute(
-        "INSERT INTO user_promos (user_id, code, active, created_at) VALUES (?, ?, 1, ?)",
-        [user_id, code, now],
-    )
-    row = await get_user_promo(user_id)
-    assert row is not None
-    return row
+    for _ in range(_PROMO_CODE_ATTEMPTS):
+        code = _random_promo_code()
+        now = datetime.now().isoformat(timespec="seconds")
+        # Вставка и чтение за один round trip: INSERT ничего не делает, если промокод
+        # уже есть, телефона нет или код случайно совпал с чужим.
+        _, select_result = await _execute_batch([
+            (
+                "INSERT INTO user_promos (user_id, code, active, created_at, valid_until)"
+                " SELECT ?, ?, 1, ?, ?"
+                " WHERE EXISTS (SELECT 1 FROM users WHERE user_id = ?"
+                " AND phone IS NOT NULL AND phone != '')"
+                " AND NOT EXISTS (SELECT 1 FROM user_promos WHERE code = ?)"
+                " ON CONFLICT(user_id) DO NOTHING",
+                [user_id, code, now, _promo_valid_until(now), user_id, code],
+            ),
+            (
+                "SELECT user_id, code, active, created_at FROM user_promos WHERE user_id = ?",
+                [user_id],
+            ),
+        ])
+        _profile_cache.pop(user_id)
+        rows = _rows(select_result)
+        if rows:
+            _replica_upsert("user_promos", rows[0])
+            return _promo_row(rows[0])
+        if not await get_phone(user_id):
+            raise ValueError("промокод выдаётся только при сохранённом номере телефона")
+    raise RuntimeError("не удалось сгенерировать уникальный промокод")
 
 
 async def deactivate_user_promo(user_id: int) -> bool:
@@ -290,6 +1272,8 @@ async def deactivate_user_promo(user_id: int) -> bool:
     if await get_user_promo(user_id) is None:
         return False
     await _execute("UPDATE user_promos SET active = 0 WHERE user_id = ?", [user_id])
+    _replica_write("UPDATE user_promos SET active = 0 WHERE user_id = ?", [user_id])
+    _profile_cache.pop(user_id)
     return True
 
 
@@ -298,17 +1282,23 @@ async def reissue_user_promo(user_id: int) -> dict:
     Перевыдаёт промокод: новый код, active=1, обновлённый created_at.
     Старый код перестаёт существовать в базе.
     """
-    if await get_user_promo(user_id) is None:
-        raise ValueError("промокод ещё не создавался")
-    code = await _new_unique_promo_code()
-    now = datetime.now().isoformat(timespec="seconds")
-    await _execute(
-        "UPDATE user_promos SET code = ?, active = 1, created_at = ? WHERE user_id = ?",
-        [code, now, user_id],
-    )
-    row = await get_user_promo(user_id)
-    assert row is not None
-    return row
+    for _ in range(_PROMO_CODE_ATTEMPTS):
+        code = _random_promo_code()
+        now = datetime.now().isoformat(timespec="seconds")
+        result = await _execute(
+            "UPDATE user_promos SET code = ?, active = 1, created_at = ?, valid_until = ?"
+            " WHERE user_id = ? AND NOT EXISTS (SELECT 1 FROM user_promos WHERE code = ?)"
+            " RETURNING user_id, code, active, created_at",
+            [code, now, _promo_valid_until(now), user_id, code],
+        )
+        _profile_cache.pop(user_id)
+        rows = _rows(result)
+        if rows:
+            _replica_upsert("user_promos", rows[0])
+            return _promo_row(rows[0])
+        if await get_user_promo(user_id) is None:
+            raise ValueError("промокод ещё не создавался")
+    raise RuntimeError("не удалось сгенерировать уникальный промокод")
 
 
 async def get_promo_by_code(code: str) -> dict | None:
@@ -320,137 +1310,600 @@ async def get_promo_by_code(code: str) -> dict | None:
         [normalized],
     )
     rows = _rows(result)
-    if not rows:
-        return None
-    row = rows[0]
-    av = row["active"]
-    active = bool(int(av)) if av is not None else True
-    return {
-        "user_id": int(row["user_id"]),
-        "code": row["code"],
-        "active": active,
-        "created_at": row["created_at"],
-    }
+    return _promo_row(rows[0]) if rows else None
 
 
-async def redeem_promo_code(code: str, *, discount_percent: int) -> dict:
+async def redeem_promo_code(
+    code: str,
+    *,
+    discount_percent: int,
+    idempotency_key: str | None = None,
+) -> dict:
     """
     Одноразово погасить промокод NR-* из базы бота.
     Возвращает user_id, code, discount_percent.
+
+    Успешное погашение — один условный UPDATE (код, активность и срок проверяются в SQL);
+    причина отказа выясняется отдельным запросом только при неудаче.
+
+    С idempotency_key успех записывается в promo_idempotency в той же транзакции, а при
+    отказе сначала ищется сохранённый результат: повтор после таймаута получает тот же
+    ответ, а не already_used. Тот же ключ с другим кодом — idempotency_key_reused; UPDATE
+    проверяет ключ сам, поэтому второй код не гасится и после рестарта или в другом процессе.
     """
     normalized = normalize_promo_code(code)
     if not normalized:
         raise PromoRedeemError("invalid_format")
 
-    existing = await get_promo_by_code(normalized)
-    if existing is None:
-        raise PromoRedeemError("not_found")
-    if not existing["active"]:
-        raise PromoRedeemError("already_used")
-    if not is_promo_still_valid(existing.get("created_at")):
-        raise PromoRedeemError("expired")
-
-    result = await _execute(
-        "UPDATE user_promos SET active = 0 WHERE code = ? AND active = 1 "
-        "RETURNING user_id, code",
-        [normalized],
+    today = datetime.now(_PROMO_TZ).date()
+    redeem_sql = (
+        "UPDATE user_promos SET active = 0"
+        f" WHERE code = ? AND active = 1 AND {_PROMO_IN_TERM_SQL}"
     )
+    redeem_args = [normalized, *_promo_term_args(today)]
+    if idempotency_key is None:
+        result = await _execute(f"{redeem_sql} RETURNING user_id, code", redeem_args)
+    else:
+        now = datetime.now()
+        cutoff = datetime.fromtimestamp(now.timestamp() - PROMO_IDEMPOTENCY_TTL)
+        _, result, _ = await _execute_batch([
+            (
+                "DELETE FROM promo_idempotency WHERE created_at < ?",
+                [cutoff.isoformat(timespec="seconds")],
+            ),
+            (
+                # Ключ уже занят другим кодом — не гасим; причину найдёт запрос ниже.
+                f"{redeem_sql} AND NOT EXISTS (SELECT 1 FROM promo_idempotency"
+                " WHERE key = ? AND code != ?)"
+                " RETURNING user_id, code",
+                [*redeem_args, idempotency_key, normalized],
+            ),
+            (
+                # changes() — число строк, погашенных предыдущим UPDATE.
+                "INSERT INTO promo_idempotency"
+                " (key, code, user_id, discount_percent, created_at)"
+                " SELECT ?, code, user_id, ?, ? FROM user_promos"
+                " WHERE code = ? AND changes() > 0"
+                " ON CONFLICT(key) DO NOTHING",
+                [idempotency_key, discount_percent, now.isoformat(timespec="seconds"),
+                 normalized],
+            ),
+        ])
     rows = _rows(result)
     if rows:
+        _replica_write("UPDATE user_promos SET active = 0 WHERE code = ?", [normalized])
+        _profile_cache.pop(rows[0]["user_id"])
         return {
-            "user_id": int(rows[0]["user_id"]),
+            "user_id": rows[0]["user_id"],
             "code": rows[0]["code"],
             "discount_percent": discount_percent,
         }
 
-    raise PromoRedeemError("already_used")
+    lookup = ("SELECT active FROM user_promos WHERE code = ?", [normalized])
+    if idempotency_key is None:
+        existing = _tuples(await _execute(*lookup))
+    else:
+        stored, promo = await _execute_batch([
+            (
+                "SELECT code, user_id, discount_percent FROM promo_idempotency"
+                " WHERE key = ? AND created_at >= ?",
+                [idempotency_key, cutoff.isoformat(timespec="seconds")],
+            ),
+            lookup,
+        ])
+        for stored_code, user_id, stored_percent in _tuples(stored):
+            if stored_code != normalized:
+                raise PromoRedeemError("idempotency_key_reused")
+            logger.info("promo redeem replayed: key=%r code=%s", idempotency_key, stored_code)
+            return {"user_id": user_id, "code": stored_code, "discount_percent": stored_percent}
+        existing = _tuples(promo)
+
+    if not existing:
+        raise PromoRedeemError("not_found")
+    if not existing[0][0]:
+        raise PromoRedeemError("already_used")
+    raise PromoRedeemError("expired")
+
+
+def _promo_error(row: tuple | None, today: str) -> str | None:
+    """Причина, по которой код нельзя погасить; row — (active, valid_until, created_at) или None."""
+    if row is None:
+        return "not_found"
+    active, valid_until, created_at = row
+    if not active:
+        return "already_used"
+    valid_until = _effective_valid_until(valid_until, created_at)
+    if valid_until is not None and valid_until < today:
+        return "expired"
+    return None
+
+
+async def get_promo_status(code: str) -> dict | None:
+    """
+    Состояние кода без погашения: status — active | already_used | expired,
+    valid_until — последний день действия. None — кода нет или неверный формат.
+    """
+    normalized = normalize_promo_code(code)
+    if not normalized:
+        return None
+    result = await _execute(
+        "SELECT active, valid_until, created_at FROM user_promos WHERE code = ?",
+        [normalized],
+    )
+    rows = _tuples(result)
+    if not rows:
+        return None
+    today = datetime.now(_PROMO_TZ).date().isoformat()
+    return {
+        "code": normalized,
+        "status": _promo_error(rows[0], today) or "active",
+        "valid_until": _effective_valid_until(rows[0][1], rows[0][2]),
+    }
+
+
+def _batch_codes(codes: list[str]) -> tuple[list[str | None], list[str]]:
+    """Нормализованные коды в порядке запроса (None — неверный формат) и уникальные валидные."""
+    normalized = [normalize_promo_code(c) if isinstance(c, str) else None for c in codes]
+    return normalized, list(dict.fromkeys(c for c in normalized if c))
+
+
+def _batch_result(code, normalized: str | None, error: str | None, **fields) -> dict:
+    if normalized is None:
+        return {"code": code, "ok": False, "error": "invalid_format"}
+    if error:
+        return {"code": normalized, "ok": False, "error": error}
+    return {"code": normalized, "ok": True, **fields}
+
+
+async def validate_promo_codes(codes: list[str], *, discount_percent: int) -> list[dict]:
+    """
+    Проверка пачки кодов без погашения: один SELECT … IN (…).
+    Результаты — в порядке запроса, ошибки — как у redeem_promo_code.
+    """
+    normalized, unique = _batch_codes(codes)
+    found: dict[str, tuple] = {}
+    if unique:
+        result = await _execute(
+            "SELECT code, user_id, active, valid_until, created_at FROM user_promos"
+            f" WHERE code IN ({', '.join('?' * len(unique))})",
+            unique,
+        )
+        found = {code: rest for code, *rest in _tuples(result)}
+    today = datetime.now(_PROMO_TZ).date().isoformat()
+    results = []
+    for code, norm in zip(codes, normalized):
+        row = found.get(norm)
+        error = _promo_error(row and row[1:], today)
+        results.append(_batch_result(
+            code, norm, error,
+            user_id=row and row[0],
+            valid_until=row and _effective_valid_until(row[2], row[3]),
+            discount_percent=discount_percent,
+        ))
+    return results
+
+
+async def redeem_promo_codes(codes: list[str], *, discount_percent: int) -> list[dict]:
+    """
+    Погашение пачки кодов за один round trip: в одной транзакции SELECT состояния до
+    погашения (для причин отказа) и условный UPDATE … RETURNING.
+    Повтор кода в пачке — already_used, как повторный запрос.
+    """
+    normalized, unique = _batch_codes(codes)
+    found: dict[str, tuple] = {}
+    redeemed: dict[str, int] = {}
+    today = datetime.now(_PROMO_TZ).date()
+    if unique:
+        placeholders = ", ".join("?" * len(unique))
+        before, updated = await _execute_batch([
+            (
+                "SELECT code, active, valid_until, created_at FROM user_promos"
+                f" WHERE code IN ({placeholders})",
+                unique,
+            ),
+            (
+                "UPDATE user_promos SET active = 0"
+                f" WHERE code IN ({placeholders}) AND active = 1 AND {_PROMO_IN_TERM_SQL}"
+                " RETURNING user_id, code",
+                [*unique, *_promo_term_args(today)],
+            ),
+        ])
+        found = {code: rest for code, *rest in _tuples(before)}
+        redeemed = {code: user_id for user_id, code in _tuples(updated)}
+        for code, user_id in redeemed.items():
+            _replica_write("UPDATE user_promos SET active = 0 WHERE code = ?", [code])
+            _profile_cache.pop(user_id)
+
+    results = []
+    seen: set[str] = set()
+    for code, norm in zip(codes, normalized):
+        if norm in redeemed and norm not in seen:
+            error = None
+        elif norm in redeemed:
+            error = "already_used"
+        else:
+            # Код не погашен этим UPDATE: активный и в срок здесь может быть только повтор.
+            error = _promo_error(found.get(norm), today.isoformat()) or "already_used"
+        if norm:
+            seen.add(norm)
+        results.append(_batch_result(
+            code, norm, error, user_id=redeemed.get(norm), discount_percent=discount_percent,
+        ))
+    return results
+
+
+# ── Клиенты API ────────────────────────────────────────────────────
+_API_CLIENT_COLUMNS = "id, name, secret_hash, endpoints, discount_percent, active, version"
+
+
+def hash_api_secret(secret: str) -> str:
+    """Секреты — 32 случайных байта, поэтому достаточно sha256 (и его можно искать по индексу)."""
+    return hashlib.sha256(secret.encode()).hexdigest()
+
+
+def _api_client(row: dict) -> dict:
+    return {
+        **row,
+        "endpoints": row["endpoints"].split(",") if row["endpoints"] else None,
+        "active": bool(row["active"]),
+    }
+
+
+async def get_api_clients(*, since_version: int = 0) -> list[dict]:
+    """Клиенты (в т.ч. отключённые), изменённые после since_version."""
+    result = await _execute(
+        f"SELECT {_API_CLIENT_COLUMNS} FROM api_clients WHERE version > ? ORDER BY version",
+        [since_version],
+    )
+    return [_api_client(row) for row in _rows(result)]
+
+
+async def create_api_client(
+    name: str,
+    *,
+    endpoints: list[str] | None = None,
+    discount_percent: int | None = None,
+) -> tuple[dict, str]:
+    """Новый клиент; возвращает (клиент, секрет). Секрет в базе не хранится — показать один раз."""
+    secret = secrets.token_hex(32)
+    result = await _execute(
+        "INSERT INTO api_clients"
+        " (name, secret_hash, endpoints, discount_percent, version, created_at)"
+        " VALUES (?, ?, ?, ?, (SELECT COALESCE(MAX(version), 0) + 1 FROM api_clients), ?)"
+        f" ON CONFLICT(name) DO NOTHING RETURNING {_API_CLIENT_COLUMNS}",
+        [name, hash_api_secret(secret), ",".join(endpoints) if endpoints else None,
+         discount_percent, datetime.now().isoformat(timespec="seconds")],
+    )
+    rows = _rows(result)
+    if not rows:
+        raise ValueError(f"клиент {name} уже существует")
+    return _api_client(rows[0]), secret
+
+
+async def set_api_client_active(name: str, active: bool) -> bool:
+    result = await _execute(
+        "UPDATE api_clients SET active = ?,"
+        " version = (SELECT COALESCE(MAX(version), 0) + 1 FROM api_clients)"
+        " WHERE name = ? RETURNING id",
+        [int(active), name],
+    )
+    return bool(_tuples(result))
+
+
+_API_USAGE_RETENTION = timedelta(days=7)
+
+
+async def save_api_usage(process: str, rows: list[tuple[str, str, int, int, list[int]]]):
+    """
+    Поминутные счётчики одного процесса: [(клиент, минута, запросы, ошибки, корзины задержки)].
+    Строка минуты перезаписывается целиком, так что повтор той же записи ничего не удваивает.
+    Заодно удаляет строки старше _API_USAGE_RETENTION.
+    """
+    if not rows:
+        return
+    statements = [
+        (
+            "INSERT OR REPLACE INTO api_client_usage"
+            " (client, minute, process, requests, errors, latency) VALUES (?, ?, ?, ?, ?, ?)",
+            [client, minute, process, requests, errors, json.dumps(latency)],
+        )
+        for client, minute, requests, errors, latency in rows
+    ]
+    statements.append((
+        "DELETE FROM api_client_usage WHERE minute < ?",
+        [(datetime.now() - _API_USAGE_RETENTION).strftime("%Y-%m-%dT%H:%M")],
+    ))
+    await _execute_batch(statements)
+
+
+async def get_api_usage(since: str) -> dict[str, dict]:
+    """Нагрузка всех процессов с минуты since: клиент → запросы, ошибки, корзины задержки."""
+    totals_result, latency_result = await _execute_batch([
+        (
+            "SELECT client, SUM(requests) AS requests, SUM(errors) AS errors"
+            " FROM api_client_usage WHERE minute >= ? GROUP BY client",
+            [since],
+        ),
+        (
+            "SELECT u.client, CAST(b.key AS INTEGER) AS bucket, SUM(b.value) AS count"
+            " FROM api_client_usage u, json_each(u.latency) b"
+            " WHERE u.minute >= ? GROUP BY u.client, b.key",
+            [since],
+        ),
+    ])
+    usage = {
+        row["client"]: {"requests": row["requests"], "errors": row["errors"], "latency": {}}
+        for row in _rows(totals_result)
+    }
+    for row in _rows(latency_result):
+        usage[row["client"]]["latency"][row["bucket"]] = row["count"]
+    return usage
+
+
+# ── Настройки ──────────────────────────────────────────────────────
+# Вся таблица загружается на старте одним запросом; после этого отсутствующий ключ — None
+# без похода в базу. Изменения с других инстансов подтягиваются по версии (run_settings_refresh).
+
+
+def _apply_settings(rows: list[tuple]) -> None:
+    global _settings_version
+    for key, value, version in rows:
+        _settings_cache[key] = value
+        _settings_version = max(_settings_version, version)
+
+
+async def load_settings():
+    global _settings_loaded
+    result = await _execute("SELECT key, value, version FROM settings")
+    _settings_cache.clear()
+    _apply_settings(_tuples(result))
+    _settings_loaded = True
+
+
+async def refresh_settings():
+    """Подтягивает настройки, изменённые после последней известной версии (индексный запрос)."""
+    result = await _execute(
+        "SELECT key, value, version FROM settings WHERE version > ?",
+        [_settings_version],
+    )
+    _apply_settings(_tuples(result))
+
+
+async def run_settings_refresh() -> None:
+    """Фоновая задача: опрашивает изменения настроек каждые SETTINGS_POLL_INTERVAL секунд."""
+    while True:
+        await asyncio.sleep(SETTINGS_POLL_INTERVAL)
+        try:
+            await refresh_settings()
+        except TursoError as e:
+            logger.warning("settings refresh failed: %s", e)
 
 
 async def get_setting(key: str) -> str | None:
     if key in _settings_cache:
         return _settings_cache[key]
-    result = await _execute("SELECT value FROM settings WHERE key = ?", [key])
-    rows = _rows(result)
+    if _settings_loaded:
+        return None
+    rows = await _read("SELECT value FROM settings WHERE key = ?", [key])
     value = rows[0]["value"] if rows else None
     _settings_cache[key] = value
     return value
 
 
 async def set_setting(key: str, value: str):
-    _settings_cache[key] = value
+    """Запись в Turso, затем в кэш; ошибка базы пробрасывается — кэш не расходится с базой."""
     await _execute(
-        "INSERT INTO settings (key, value) VALUES (?, ?)"
-        " ON CONFLICT(key) DO UPDATE SET value = excluded.value",
-        [key, value],
+        "INSERT INTO settings (key, value, version, updated_at)"
+        " VALUES (?, ?, (SELECT COALESCE(MAX(version), 0) + 1 FROM settings), ?)"
+        " ON CONFLICT(key) DO UPDATE SET value = excluded.value,"
+        " version = excluded.version, updated_at = excluded.updated_at",
+        [key, value, datetime.now().isoformat(timespec="seconds")],
     )
+    _settings_cache[key] = value
+    _replica_upsert("settings", {"key": key, "value": value})
 
 
 async def user_exists(user_id: int) -> bool:
-    result = await _execute("SELECT user_id FROM users WHERE user_id = ?", [user_id])
-    return len(_rows(result)) > 0
+    return (await _profile(user_id))["exists"]
 
 
-async def _next_giveaway_number() -> int:
-    result = await _execute("SELECT MAX(giveaway_number) as max_num FROM users")
-    rows = _rows(result)
-    if rows and rows[0]["max_num"] is not None:
-        return int(rows[0]["max_num"]) + 1
-    return 1
+async def get_giveaway_number(user_id: int) -> int | None:
+    return (await _profile(user_id))["giveaway_number"]
 
 
-async def assign_missing_giveaway_numbers():
-    result = await _execute("SELECT id FROM users WHERE giveaway_number IS NULL ORDER BY id")
+async def add_user(user_id: int, username: str, first_name: str, last_name: str):
+    # Проверка существования, номер розыгрыша и вставка — одним запросом. Запись в Turso
+    # сериализуется, поэтому MAX()+1 внутри INSERT атомарен; уникальный индекс — страховка.
+    result = await _execute(
+        "INSERT INTO users (user_id, username, first_name, last_name, joined_at, giveaway_number)"
+        " VALUES (?, ?, ?, ?, ?, (SELECT COALESCE(MAX(giveaway_number), 0) + 1 FROM users))"
+        " ON CONFLICT(user_id) DO NOTHING"
+        " RETURNING user_id, phone, giveaway_number",
+        [user_id, username, first_name, last_name,
+         datetime.now().isoformat(timespec="seconds")],
+    )
     for row in _rows(result):
-        number = await _next_giveaway_number()
-        await _execute("UPDATE users SET giveaway_number = ? WHERE id = ?", [number, int(row["id"])])
+        _replica_upsert("users", row)
+    _profile_cache.pop(user_id)
 
 
-async def get_giveaway_number(user_id: int) -> int | None:
-    result = await _execute("SELECT giveaway_number FROM users WHERE user_id = ?", [user_id])
-    rows = _rows(result)
-    val = rows[0]["giveaway_number"] if rows else None
-    return int(val) if val is not None else None
+async def get_unreported_giveaway_number_changes() -> list[dict]:
+    """Номера розыгрыша, сменённые миграцией 3 (повторы), о которых админам ещё не сообщили."""
+    result = await _execute(
+        "SELECT rowid AS id, user_id, old_number, new_number FROM giveaway_number_changes"
+        " WHERE reported_at IS NULL ORDER BY rowid"
+    )
+    return _rows(result)
 
 
-async def add_user(user_id: int, username: str, first_name: str, last_name: str):
-    if await user_exists(user_id):
+async def mark_giveaway_number_changes_reported(ids: list[int]):
+    if not ids:
         return
-    number = await _next_giveaway_number()
     await _execute(
-        "INSERT INTO users (user_id, username, first_name, last_name, joined_at, giveaway_number)"
-        " VALUES (?, ?, ?, ?, ?, ?)",
-        [user_id, username, first_name, last_name,
-         datetime.now().isoformat(timespec="seconds"), number],
+        f"UPDATE giveaway_number_changes SET reported_at = ?"
+        f" WHERE rowid IN ({', '.join('?' * len(ids))})",
+        [datetime.now().isoformat(timespec="seconds"), *ids],
     )
 
 
 async def get_all_user_ids() -> list[int]:
     result = await _execute("SELECT user_id FROM users")
-    return [int(row["user_id"]) for row in _rows(result)]
+    return [user_id for user_id, in _tuples(result)]
+
+
+# ── Рассылки ───────────────────────────────────────────────────────
+_BROADCAST_CHUNK = 500
+# Статусы получателя, после которых пользователь помечается недоставляемым.
+UNDELIVERABLE_STATUSES = ("blocked", "deactivated", "chat_not_found")
+_BROADCAST_JOB_COLUMNS = "id, payload, total, sent, failed, status_chat_id, status_message_id"
+
+
+def _broadcast_job(row: dict) -> dict:
+    return {
+        **row,
+        "payload": json.loads(row["payload"]),
+    }
+
+
+async def create_broadcast_job(payload: dict, status_chat_id: int, status_message_id: int) -> dict:
+    """
+    Создаёт задание рассылки и список получателей (доставляемые пользователи) одной транзакцией.
+    Пакет не передаёт результат шага в следующий, поэтому id задания берём из last_insert_rowid()
+    того же соединения: вставка в broadcast_recipients (WITHOUT ROWID) его не меняет.
+    """
+    _, _, result = await _execute_batch([
+        (
+            "INSERT INTO broadcast_jobs (payload, status_chat_id, status_message_id, created_at)"
+            " VALUES (?, ?, ?, ?)",
+            [json.dumps(payload, ensure_ascii=False), status_chat_id, status_message_id,
+             datetime.now().isoformat(timespec="seconds")],
+        ),
+        (
+            "INSERT INTO broadcast_recipients (job_id, user_id)"
+            " SELECT last_insert_rowid(), user_id FROM users WHERE undeliverable IS NULL",
+            None,
+        ),
+        (
+            "UPDATE broadcast_jobs SET total ="
+            " (SELECT COUNT(*) FROM broadcast_recipients WHERE job_id = broadcast_jobs.id)"
+            f" WHERE id = last_insert_rowid() RETURNING {_BROADCAST_JOB_COLUMNS}",
+            None,
+        ),
+    ])
+    return _broadcast_job(_rows(result)[0])
+
+
+async def get_running_broadcast_jobs() -> list[dict]:
+    result = await _execute(
+        f"SELECT {_BROADCAST_JOB_COLUMNS} FROM broadcast_jobs WHERE status = 'running' ORDER BY id"
+    )
+    return [_broadcast_job(row) for row in _rows(result)]
+
+
+async def get_broadcast_pending_user_ids(job_id: int) -> list[int]:
+    result = await _execute(
+        "SELECT user_id FROM broadcast_recipients WHERE job_id = ? AND status = 'pending'",
+        [job_id],
+    )
+    return [user_id for user_id, in _tuples(result)]
+
+
+async def record_broadcast_results(job_id: int, results: list[tuple[int, str]]):
+    """
+    Сохраняет статусы получателей и счётчики задания одним round trip.
+    status: sent | failed | один из UNDELIVERABLE_STATUSES (пользователь исключается из рассылок).
+    Повтор того же пакета ничего не меняет: статус пишется только у ожидающих получателей,
+    а счётчики пересчитываются по broadcast_recipients.
+    """
+    if not results:
+        return
+    by_status: dict[str, list[int]] = {}
+    for user_id, status in results:
+        by_status.setdefault(status, []).append(user_id)
+    now = datetime.now().isoformat(timespec="seconds")
+    statements = []
+    for status, user_ids in by_status.items():
+        for i in range(0, len(user_ids), _BROADCAST_CHUNK):
+            chunk = user_ids[i:i + _BROADCAST_CHUNK]
+            placeholders = ", ".join("?" * len(chunk))
+            statements.append((
+                "UPDATE broadcast_recipients SET status = ?"
+                f" WHERE job_id = ? AND status = 'pending' AND user_id IN ({placeholders})",
+                [status, job_id, *chunk],
+            ))
+            if status in UNDELIVERABLE_STATUSES:
+                statements.append((
+                    "UPDATE users SET blocked_at = ?, undeliverable = ?"
+                    f" WHERE user_id IN ({placeholders})",
+                    [now, status, *chunk],
+                ))
+    statements.append((
+        "UPDATE broadcast_jobs SET"
+        " sent = (SELECT COUNT(*) FROM broadcast_recipients"
+        " WHERE job_id = broadcast_jobs.id AND status = 'sent'),"
+        " failed = (SELECT COUNT(*) FROM broadcast_recipients"
+        " WHERE job_id = broadcast_jobs.id AND status NOT IN ('pending', 'sent'))"
+        " WHERE id = ?",
+        [job_id],
+    ))
+    await _execute_batch(statements)
+
+
+async def set_user_reachable(user_id: int, reachable: bool):
+    """Отметка по my_chat_member: пользователь заблокировал бота или снова разрешил сообщения."""
+    if reachable:
+        await _execute(
+            "UPDATE users SET blocked_at = NULL, undeliverable = NULL"
+            " WHERE user_id = ? AND undeliverable IS NOT NULL",
+            [user_id],
+        )
+    else:
+        await _execute(
+            "UPDATE users SET blocked_at = ?, undeliverable = 'blocked' WHERE user_id = ?",
+            [datetime.now().isoformat(timespec="seconds"), user_id],
+        )
+
+
+async def finish_broadcast_job(job_id: int, status: str = "done"):
+    """status: done | failed (прервана ошибкой — после рестарта не возобновляется)."""
+    await _execute(
+        "UPDATE broadcast_jobs SET status = ?, finished_at = ? WHERE id = ?",
+        [status, datetime.now().isoformat(timespec="seconds"), job_id],
+    )
 
 
 async def get_phone(user_id: int) -> str | None:
-    result = await _execute("SELECT phone FROM users WHERE user_id = ?", [user_id])
-    rows = _rows(result)
-    return rows[0]["phone"] if rows else None
+    return (await _profile(user_id))["phone"]
 
 
 async def save_phone(user_id: int, phone: str):
-    await _execute("UPDATE users SET phone = ? WHERE user_id = ?", [phone, user_id])
+    await _execute(
+        "UPDATE users SET phone = ?, phone_digits = ?, phone_last9 = ? WHERE user_id = ?",
+        [phone, *_phone_keys(phone), user_id],
+    )
+    _replica_write("UPDATE users SET phone = ? WHERE user_id = ?", [phone, user_id])
+    _profile_cache.pop(user_id)
 
 
 async def get_stats() -> dict:
-    count_result = await _execute("SELECT COUNT(*) as total FROM users")
-    total = int(_rows(count_result)[0]["total"])
+    count_result, recent_result = await _execute_batch([
+        ("SELECT undeliverable, COUNT(*) as total FROM users GROUP BY undeliverable", None),
+        ("SELECT first_name, username, joined_at FROM users ORDER BY id DESC LIMIT 5", None),
+    ])
+    unreachable: dict[str, int] = {}
+    reachable = 0
+    for row in _rows(count_result):
+        if row["undeliverable"] is None:
+            reachable = row["total"]
+        else:
+            unreachable[row["undeliverable"]] = row["total"]
+    total = reachable + sum(unreachable.values())
 
-    recent_result = await _execute(
-        "SELECT first_name, username, joined_at FROM users ORDER BY id DESC LIMIT 5"
-    )
     recent = [
         (row["first_name"], row["username"], row["joined_at"])
         for row in _rows(recent_result)
     ]
-    return {"total": total, "recent": recent}
+    return {"total": total, "reachable": reachable, "unreachable": unreachable, "recent": recent}
 
 
 async def save_review(user_id: int, project: str, rating: int, email: str | None, text: str):
@@ -468,26 +1921,77 @@ async def get_reviews(limit: int = 20) -> list:
     return _rows(result)
 
 
-async def export_reviews_csv() -> str:
-    result = await _execute(
-        "SELECT project, rating, email, text, created_at FROM reviews ORDER BY id DESC"
+# ── Экспорт ────────────────────────────────────────────────────────
+_EXPORT_PAGE = 1000
+_EXPORT_SPOOL_MAX = 1024 * 1024
+
+
+async def _iter_pages(table: str, columns: list[str], *, descending: bool = False):
+    """
+    Keyset-пагинация по id: читаем страницами, память не растёт вместе с таблицей.
+    Отдаёт страницы — списки кортежей (id, *columns).
+    """
+    cmp, order = ("<", "DESC") if descending else (">", "ASC")
+    select = f"SELECT id, {', '.join(columns)} FROM {table}"
+    last_id: int | None = None
+    while True:
+        if last_id is None:
+            result = await _execute(f"{select} ORDER BY id {order} LIMIT ?", [_EXPORT_PAGE])
+        else:
+            result = await _execute(
+                f"{select} WHERE id {cmp} ? ORDER BY id {order} LIMIT ?",
+                [last_id, _EXPORT_PAGE],
+            )
+        rows = _tuples(result)
+        if rows:
+            yield rows
+        if len(rows) < _EXPORT_PAGE:
+            return
+        last_id = rows[-1][0]
+
+
+async def _export_csv(
+    table: str,
+    columns: list[str],
+    *,
+    descending: bool = False,
+    compress: bool = False,
+) -> tempfile.SpooledTemporaryFile:
+    """
+    CSV во временный файл (в памяти до 1 МБ, дальше на диске), по желанию gzip; позиция — 0.
+    Форматирование, сжатие и запись на диск — в пуле потоков, постранично.
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=_EXPORT_SPOOL_MAX)
+    raw = gzip.GzipFile(fileobj=spool, mode="wb") if compress else spool
+    text = io.TextIOWrapper(raw, encoding="utf-8", newline="")
+    writer = csv.writer(text)
+    writer.writerow(columns)
+    async for rows in _iter_pages(table, columns, descending=descending):
+        await executor.run_blocking(writer.writerows, [row[1:] for row in rows])
+
+    def finish() -> None:
+        text.flush()
+        text.detach()
+        if compress:
+            raw.close()
+        spool.seek(0)
+
+    await executor.run_blocking(finish)
+    return spool
+
+
+async def export_reviews_csv(*, compress: bool = False) -> tempfile.SpooledTemporaryFile:
+    return await _export_csv(
+        "reviews",
+        ["project", "rating", "email", "text", "created_at"],
+        descending=True,
+        compress=compress,
     )
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(["project", "rating", "email", "text", "created_at"])
-    for row in _rows(result):
-        writer.writerow([row["project"], row["rating"], row["email"], row["text"], row["created_at"]])
-    return output.getvalue()
 
 
-async def export_csv() -> str:
-    result = await _execute(
-        "SELECT user_id, username, first_name, last_name, phone, joined_at FROM users ORDER BY id"
+async def export_csv(*, compress: bool = False) -> tempfile.SpooledTemporaryFile:
+    return await _export_csv(
+        "users",
+        ["user_id", "username", "first_name", "last_name", "phone", "joined_at"],
+        compress=compress,
     )
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(["user_id", "username", "first_name", "last_name", "phone", "joined_at"])
-    for row in _rows(result):
-        writer.writerow([row["user_id"], row["username"], row["first_name"],
-                         row["last_name"], row["phone"], row["joined_at"]])
-    return output.getvalue()
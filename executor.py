@@ -0,0 +1,119 @@
+"""Общий пул для блокирующей работы и контроль задержки event loop."""
+
+from __future__ import annotations
+
+import asyncio
+import functools
+import logging
+import multiprocessing
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+
+import config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Как часто монитор просыпается; опоздание пробуждения и есть задержка loop.
+_SAMPLE_INTERVAL = 0.1
+
+_threads = ThreadPoolExecutor(max_workers=config.BLOCKING_POOL_SIZE, thread_name_prefix="blocking")
+_processes: ProcessPoolExecutor | None = None
+
+
+def _cpu_pool() -> Executor:
+    """
+    Пул процессов для чистого Python, который держит GIL (рендер QR).
+    По умолчанию выключен (CPU_POOL_SIZE=0) — тогда работа уходит в пул потоков.
+    """
+    global _processes
+    if config.CPU_POOL_SIZE <= 0:
+        return _threads
+    if _processes is None:
+        # spawn: fork процесса с потоками PTB/httpx небезопасен.
+        _processes = ProcessPoolExecutor(
+            max_workers=config.CPU_POOL_SIZE,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _processes
+
+
+async def run_blocking(func, *args, **kwargs):
+    """Выполняет блокирующую функцию (I/O, zlib, csv) в общем пуле потоков."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_threads, functools.partial(func, *args, **kwargs))
+
+
+async def run_cpu(func, *args, **kwargs):
+    """Выполняет CPU-задачу в пуле процессов; func и аргументы должны сериализоваться pickle."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_cpu_pool(), functools.partial(func, *args, **kwargs))
+
+
+def shutdown() -> None:
+    _threads.shutdown(wait=False, cancel_futures=True)
+    if _processes is not None:
+        _processes.shutdown(wait=False, cancel_futures=True)
+
+
+# ── Задержка event loop ────────────────────────────────────────────
+_stats = {"last_lag_ms": 0.0, "max_lag_ms": 0.0, "stalls": 0}
+_heartbeat = time.monotonic()
+
+
+def loop_stats() -> dict:
+    return dict(_stats)
+
+
+@metrics.collector
+def _loop_metrics() -> list:
+    lag = [("", {}, _stats["last_lag_ms"] / 1000)]
+    stalls = [("", {}, _stats["stalls"])]
+    return [
+        ("event_loop_lag_seconds", "gauge", "Последняя измеренная задержка event loop", lag),
+        ("event_loop_stalls_total", "counter", "Задержки loop дольше LOOP_LAG_WARN_MS", stalls),
+    ]
+
+
+def _watchdog(loop_thread_id: int, threshold: float) -> None:
+    """
+    Поток-сторож: если loop не отметился дольше порога, пишет в лог стек потока loop —
+    видно, какой именно колбэк его держит. Об одной блокировке сообщает один раз.
+    """
+    reported_at = None
+    while True:
+        time.sleep(threshold / 2)
+        beat = _heartbeat
+        stalled = time.monotonic() - beat - _SAMPLE_INTERVAL
+        if stalled < threshold or reported_at == beat:
+            continue
+        reported_at = beat
+        frame = sys._current_frames().get(loop_thread_id)
+        stack = "".join(traceback.format_stack(frame)) if frame else "(стек недоступен)"
+        logger.warning("Event loop заблокирован уже %.0f мс:\n%s", stalled * 1000, stack)
+
+
+async def run_loop_monitor() -> None:
+    """Фоновая задача: меряет задержку loop и запускает поток-сторож (LOOP_LAG_WARN_MS)."""
+    global _heartbeat
+    threshold = config.LOOP_LAG_WARN_MS / 1000
+    threading.Thread(
+        target=_watchdog,
+        args=(threading.get_ident(), threshold),
+        name="loop-watchdog",
+        daemon=True,
+    ).start()
+    while True:
+        started = time.monotonic()
+        await asyncio.sleep(_SAMPLE_INTERVAL)
+        now = time.monotonic()
+        _heartbeat = now
+        lag = max(0.0, now - started - _SAMPLE_INTERVAL)
+        _stats["last_lag_ms"] = lag * 1000
+        _stats["max_lag_ms"] = max(_stats["max_lag_ms"], lag * 1000)
+        if lag >= threshold:
+            _stats["stalls"] += 1
+            logger.warning("Задержка event loop: %.0f мс", lag * 1000)
@@ -0,0 +1,234 @@
+"""Метрики в текстовом формате Prometheus: GET /metrics (METRICS_PORT; webhook и promo API — под токеном)."""
+
+from __future__ import annotations
+
+import bisect
+import functools
+import math
+import secrets
+import time
+
+import tornado.web
+
+import config
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Верхние границы корзин гистограмм по умолчанию, секунды.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_metrics: list = []
+# Метки всех серий процесса (worker у процессов python -m promo_api).
+_process_labels: dict = {}
+# Функции, которые при каждом scrape отдают [(имя, тип, описание, [(суффикс, метки, значение)])].
+_collectors: list = []
+_caches: dict = {}
+
+
+class Counter:
+    """Счётчик с метками: Counter(..., ("query",)).inc("select users")."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values: dict[tuple, float] = {}
+        _metrics.append(self)
+
+    def inc(self, *values: str, amount: float = 1.0) -> None:
+        self._values[values] = self._values.get(values, 0.0) + amount
+
+    def samples(self):
+        for values, value in self._values.items():
+            yield "", dict(zip(self.labels, values)), value
+
+
+class Histogram:
+    """Гистограмма с метками: observe(секунды, *значения меток)."""
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # значения меток → [счётчики корзин (последняя — +Inf), сумма]
+        self._series: dict[tuple, list] = {}
+        _metrics.append(self)
+
+    def observe(self, value: float, *values: str) -> None:
+        series = self._series.get(values)
+        if series is None:
+            series = self._series[values] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def samples(self):
+        for values, (counts, total) in self._series.items():
+            yield from histogram_samples(dict(zip(self.labels, values)), self.buckets, counts, total)
+
+
+def histogram_samples(labels: dict, buckets, counts: list[int], total: float):
+    """Серии _bucket/_sum/_count из счётчиков по корзинам (не накопленных; последняя — +Inf)."""
+    cumulative = 0
+    for bound, count in zip((*buckets, math.inf), counts):
+        cumulative += count
+        yield "_bucket", {**labels, "le": _format(bound)}, cumulative
+    yield "_sum", labels, total
+    yield "_count", labels, cumulative
+
+
+def collector(func):
+    """Регистрирует функцию, которая считает значения в момент scrape (очереди, кэши)."""
+    _collectors.append(func)
+    return func
+
+
+def register_cache(name: str, cache) -> None:
+    """Кэш с методом stats() → попадания/промахи/размер в cache_requests_total и cache_entries."""
+    _caches[name] = cache
+
+
+@collector
+def _cache_metrics() -> list:
+    requests, entries = [], []
+    for name, cache in _caches.items():
+        stats = cache.stats()
+        requests.append(("", {"cache": name, "result": "hit"}, stats["hits"]))
+        requests.append(("", {"cache": name, "result": "miss"}, stats["misses"]))
+        entries.append(("", {"cache": name}, stats["size"]))
+    return [
+        ("cache_requests_total", "counter", "Обращения к кэшам в памяти", requests),
+        ("cache_entries", "gauge", "Записей в кэше", entries),
+    ]
+
+
+def set_process_labels(**labels: str) -> None:
+    """Метки, которые добавляются ко всем сериям этого процесса."""
+    _process_labels.update(labels)
+
+
+def _format(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value))
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + "}"
+
+
+def render() -> str:
+    families = [(m.name, m.kind, m.help, m.samples()) for m in _metrics]
+    for func in _collectors:
+        families.extend(func())
+    lines = []
+    for name, kind, help, samples in families:
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {kind}")
+        for suffix, labels, value in samples:
+            labels = {**_process_labels, **labels}
+            lines.append(f"{name}{suffix}{_labels(labels)} {_format(value)}")
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """GET /metrics; если задан METRICS_TOKEN — только с Authorization: Bearer {METRICS_TOKEN}."""
+
+    SUPPORTED_METHODS = ("GET",)
+
+    def get(self) -> None:
+        if config.METRICS_TOKEN:
+            auth = self.request.headers.get("Authorization", "")
+            if not secrets.compare_digest(auth.encode(), f"Bearer {config.METRICS_TOKEN}".encode()):
+                self.set_status(401)
+                return
+        self.set_header("Content-Type", CONTENT_TYPE)
+        self.write(render())
+
+
+def start_server(port: int):
+    """Отдельный HTTP-сервер только с /metrics (polling-режим); вызывать из работающего loop."""
+    return tornado.web.Application([(r"/metrics", MetricsHandler)]).listen(port)
+
+
+# ── Бот (PTB) ──────────────────────────────────────────────────────
+_UPDATES = Counter("bot_updates_total", "Входящие апдейты Telegram по типу", ("type",))
+_HANDLER_SECONDS = Histogram(
+    "bot_handler_seconds", "Время обработчиков PTB по имени функции", ("handler",)
+)
+_HANDLER_ERRORS = Counter(
+    "bot_handler_errors_total", "Исключения в обработчиках PTB по имени функции", ("handler",)
+)
+
+
+def _timed(callback):
+    name = getattr(callback, "__name__", type(callback).__name__)
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            _HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            _HANDLER_SECONDS.observe(time.perf_counter() - started, name)
+
+    return wrapper
+
+
+def _instrument_handler(handler, conversation_type) -> None:
+    if isinstance(handler, conversation_type):
+        nested = [*handler.entry_points, *handler.fallbacks]
+        for state_handlers in handler.states.values():
+            nested.extend(state_handlers)
+        for inner in nested:
+            _instrument_handler(inner, conversation_type)
+    else:
+        handler.callback = _timed(handler.callback)
+
+
+def instrument_application(application) -> None:
+    """
+    Время и ошибки всех уже добавленных обработчиков (включая состояния ConversationHandler),
+    счётчик апдейтов по типу и глубина update_queue. Вызывать после последнего add_handler.
+    """
+    from telegram import Update
+    from telegram.ext import ConversationHandler, TypeHandler
+
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            _instrument_handler(handler, ConversationHandler)
+
+    async def count_update(update, context) -> None:
+        kind = next((t for t in Update.ALL_TYPES if getattr(update, t, None) is not None), "other")
+        _UPDATES.inc(kind)
+
+    # Группа -1 — раньше остальных обработчиков, не мешая им.
+    application.add_handler(TypeHandler(Update, count_update), group=-1)
+
+    @collector
+    def _queue() -> list:
+        return [(
+            "bot_update_queue_size",
+            "gauge",
+            "Апдейты, ожидающие обработки",
+            [("", {}, application.update_queue.qsize())],
+        )]
@@ -1,15 +1,30 @@
-"""HTTP API погашения промокодов NR-* (POST /api/promo/redeem)."""
+"""HTTP API промокодов NR-*: погашение (POST /api/promo/redeem, batch) и проверка (GET /api/promo/{code})."""
 
 from __future__ import annotations
 
+import abc
+import asyncio
+import hashlib
+import ipaddress
 import json
 import logging
+import math
+import os
 import secrets
+import signal
+import socket
+import sys
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
 
+import tornado.httpserver
+import tornado.netutil
 import tornado.web
 
 import config
 import database as db
+import metrics
 
 logger = logging.getLogger(__name__)
 
@@ -18,31 +33,393 @@ _REDEEM_ERRORS = {
     "not_found": 404,
     "already_used": 409,
     "expired": 410,
+    "idempotency_key_reused": 422,
 }
 
 
-def _check_auth(handler: tornado.web.RequestHandler) -> bool:
-    if not config.PROMO_API_SECRET:
-        return False
+# Ответы GET /api/promo/{code}: код → (HTTP-статус, данные). Погашение через API
+# этого процесса сбрасывает запись сразу, остальные изменения видны через TTL.
+_LOOKUP_CACHE_SIZE = 10_000
+_lookup_cache = db.TTLCache(_LOOKUP_CACHE_SIZE, config.PROMO_API_LOOKUP_TTL)
+
+# Ответы POST /api/promo/redeem по Idempotency-Key: (клиент, ключ) → (код, HTTP-статус, тело).
+# Повтор в том же процессе отдаётся отсюда; после рестарта или с другого инстанса —
+# из promo_idempotency (redeem_promo_code ищет его только при отказе погашения).
+_IDEMPOTENCY_CACHE_SIZE = 10_000
+_IDEMPOTENCY_KEY_MAX_LEN = 255
+_idempotency_cache = db.TTLCache(_IDEMPOTENCY_CACHE_SIZE, db.PROMO_IDEMPOTENCY_TTL)
+
+metrics.register_cache("promo_lookup", _lookup_cache)
+metrics.register_cache("promo_idempotency", _idempotency_cache)
+# Исход погашения по коду: ok, код из _REDEEM_ERRORS, replayed (ответ по Idempotency-Key), internal_error.
+_REDEEM_OUTCOMES = metrics.Counter(
+    "promo_redeem_outcomes_total", "Результаты погашения промокодов", ("endpoint", "outcome")
+)
+
+
+# ── Клиенты API ────────────────────────────────────────────────────
+# PROMO_API_SECRET из .env — клиент "default" без ограничений; остальные — в api_clients.
+_DEFAULT_CLIENT = {"name": "default", "endpoints": None, "discount_percent": None}
+# Значения для api_clients.endpoints (ENDPOINT обработчиков).
+ENDPOINTS = ("redeem", "redeem_batch", "validate_batch", "lookup")
+
+
+class _ClientIndex:
+    """
+    sha256(секрет) → клиент: поиск по токену — одно обращение к dict, без перебора.
+    Полная загрузка — при первом запросе; дальше изменения (version > ?) подтягиваются
+    в фоне не чаще раза в PROMO_API_CLIENTS_POLL секунд, запросы их не ждут.
+    """
+
+    def __init__(self):
+        self._by_hash: dict[str, dict] = {}
+        self._hash_by_id: dict[int, str] = {}
+        self._version = 0
+        self._loaded = False
+        self._checked: float | None = None
+        self._refreshing: asyncio.Future | None = None
+
+    def _apply(self, clients: list[dict]) -> None:
+        for client in clients:
+            old_hash = self._hash_by_id.pop(client["id"], None)
+            if old_hash is not None:
+                self._by_hash.pop(old_hash, None)
+            if client["active"]:
+                self._by_hash[client["secret_hash"]] = client
+                self._hash_by_id[client["id"]] = client["secret_hash"]
+            self._version = max(self._version, client["version"])
+
+    async def refresh(self) -> None:
+        self._checked = time.monotonic()
+        try:
+            clients = await db.get_api_clients(since_version=self._version)
+        except db.TursoError as e:
+            logger.warning("promo API clients refresh failed: %s", e)
+            return
+        self._apply(clients)
+        self._loaded = True
+
+    async def ensure_fresh(self) -> None:
+        due = self._checked is None or time.monotonic() - self._checked >= config.PROMO_API_CLIENTS_POLL
+        if due and (self._refreshing is None or self._refreshing.done()):
+            self._refreshing = asyncio.ensure_future(self.refresh())
+        if not self._loaded:
+            await self._refreshing
+
+    def lookup(self, token: str) -> dict | None:
+        return self._by_hash.get(db.hash_api_secret(token))
+
+
+_clients = _ClientIndex()
+
+
+async def refresh_clients() -> None:
+    """Сразу подтянуть изменения api_clients (после /apiclient в этом же процессе)."""
+    await _clients.refresh()
+
+
+def _authenticate(handler: tornado.web.RequestHandler) -> dict | None:
     auth = handler.request.headers.get("Authorization", "")
     if not auth.startswith("Bearer "):
-        return False
+        return None
     token = auth[7:].strip()
-    return secrets.compare_digest(token, config.PROMO_API_SECRET)
+    if config.PROMO_API_SECRET and secrets.compare_digest(token, config.PROMO_API_SECRET):
+        return _DEFAULT_CLIENT
+    return _clients.lookup(token)
 
 
-class PromoRedeemHandler(tornado.web.RequestHandler):
-    SUPPORTED_METHODS = ("POST",)
+# ── Учёт запросов по клиентам ──────────────────────────────────────
+# Счётчики с начала процесса — для /metrics. Поминутные раз в _USAGE_FLUSH_INTERVAL пишутся
+# в api_client_usage: /apiclient в боте видит нагрузку всех процессов, а не только своего.
+# Верхние границы корзин гистограммы задержки, мс; последняя корзина — всё, что дольше.
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+USAGE_WINDOW_HOURS = 24
+_USAGE_FLUSH_INTERVAL = 60.0
+
+_client_usage: dict[str, dict] = {}
+# (клиент, минута YYYY-MM-DDTHH:MM) → счётчики, которые ещё могут измениться или не записаны.
+_minute_usage: dict[tuple[str, str], dict] = {}
+_usage_process: str | None = None
+_usage_flusher: asyncio.Future | None = None
+
+
+def _minute(moment: datetime) -> str:
+    return moment.strftime("%Y-%m-%dT%H:%M")
+
+
+def _new_usage() -> dict:
+    return {
+        "requests": 0,
+        "errors": 0,
+        "endpoints": {},
+        "statuses": {},
+        "latency": [0] * (len(LATENCY_BUCKETS_MS) + 1),
+        "latency_sum": 0.0,
+    }
+
+
+def _add_usage(usage: dict, endpoint: str, status: int, seconds: float) -> None:
+    usage["requests"] += 1
+    if status >= 400:
+        usage["errors"] += 1
+    usage["endpoints"][endpoint] = usage["endpoints"].get(endpoint, 0) + 1
+    usage["statuses"][status] = usage["statuses"].get(status, 0) + 1
+    ms = seconds * 1000
+    bucket = next((i for i, bound in enumerate(LATENCY_BUCKETS_MS) if ms <= bound), -1)
+    usage["latency"][bucket] += 1
+    usage["latency_sum"] += seconds
+
+
+def _record_usage(client: str, endpoint: str, status: int, seconds: float) -> None:
+    global _usage_flusher
+    for store, key in ((_client_usage, client), (_minute_usage, (client, _minute(datetime.now())))):
+        usage = store.get(key)
+        if usage is None:
+            usage = store[key] = _new_usage()
+        _add_usage(usage, endpoint, status, seconds)
+    if _usage_flusher is None:
+        _usage_flusher = asyncio.ensure_future(_run_usage_flush())
+
+
+async def flush_usage() -> None:
+    """Пишет поминутные счётчики процесса в базу; завершённые минуты после записи забывает."""
+    global _usage_process
+    if not _minute_usage:
+        return
+    if _usage_process is None:
+        # Свой ключ у каждого процесса (после fork и рестарта тоже) — строки не перетирают чужие.
+        _usage_process = f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(4)}"
+    current = _minute(datetime.now())
+    await db.save_api_usage(_usage_process, [
+        (client, minute, usage["requests"], usage["errors"], list(usage["latency"]))
+        for (client, minute), usage in _minute_usage.items()
+    ])
+    # Текущая минута ещё пополняется — её перезапишет следующий flush.
+    for key in [key for key in _minute_usage if key[1] < current]:
+        del _minute_usage[key]
+
+
+async def _run_usage_flush() -> None:
+    while True:
+        await asyncio.sleep(_USAGE_FLUSH_INTERVAL)
+        try:
+            await flush_usage()
+        except db.TursoError as e:
+            logger.warning("promo API usage flush failed: %s", e)
+
+
+def _latency_percentile(histogram: list[int], q: float) -> float | None:
+    """Верхняя граница корзины, в которую попадает q-квантиль (мс); None — запросов не было."""
+    total = sum(histogram)
+    if not total:
+        return None
+    seen = 0
+    for bound, count in zip((*LATENCY_BUCKETS_MS, math.inf), histogram):
+        seen += count
+        if seen >= q * total:
+            return bound
+    return math.inf
+
+
+async def client_usage() -> dict[str, dict]:
+    """
+    Нагрузка за USAGE_WINDOW_HOURS по всем процессам (из api_client_usage, с задержкой
+    до _USAGE_FLUSH_INTERVAL): запросы, ошибки (4xx/5xx), p50/p95 задержки.
+    """
+    try:
+        await flush_usage()
+    except db.TursoError as e:
+        logger.warning("promo API usage flush failed: %s", e)
+    since = _minute(datetime.now() - timedelta(hours=USAGE_WINDOW_HOURS))
+    result = {}
+    for name, usage in (await db.get_api_usage(since)).items():
+        latency = [usage["latency"].get(i, 0) for i in range(len(LATENCY_BUCKETS_MS) + 1)]
+        result[name] = {
+            "requests": usage["requests"],
+            "errors": usage["errors"],
+            "error_rate": usage["errors"] / usage["requests"],
+            "p50_ms": _latency_percentile(latency, 0.5),
+            "p95_ms": _latency_percentile(latency, 0.95),
+        }
+    return result
+
+
+@metrics.collector
+def _usage_metrics() -> list:
+    responses, latency = [], []
+    buckets = tuple(ms / 1000 for ms in LATENCY_BUCKETS_MS)
+    for name, usage in _client_usage.items():
+        for status, count in usage["statuses"].items():
+            responses.append(("", {"client": name, "status": str(status)}, count))
+        latency.extend(metrics.histogram_samples(
+            {"client": name}, buckets, usage["latency"], usage["latency_sum"]
+        ))
+    return [
+        ("promo_api_responses_total", "counter", "Ответы promo API по клиенту и статусу", responses),
+        ("promo_api_request_seconds", "histogram", "Время запросов promo API по клиенту", latency),
+    ]
+
+
+# ── Лимиты ─────────────────────────────────────────────────────────
+_THROTTLE_MAX_KEYS = 50_000
+_LOCKOUT_BASE = 30.0
+_LOCKOUT_MAX = 3600.0
+# Счётчик неудач обнуляется, если их не было столько секунд.
+_FAILURE_WINDOW = 3600.0
+
+
+class _Throttle:
+    """
+    Token bucket по IP и по клиенту API плюс блокировка после повторных 401/404:
+    каждые PROMO_API_LOCKOUT_AFTER неудач — блокировка, вдвое длиннее предыдущей.
+    Успешные ответы счёт не сбрасывают (иначе перебор с примесью известного кода
+    не блокировался бы никогда); он обнуляется только через _FAILURE_WINDOW без неудач.
+    Всё в памяти процесса, проверка — до любого запроса к базе.
+    """
+
+    def __init__(self, *, ip_rate: float, client_rate: float, lockout_after: int):
+        self.ip_rate = ip_rate
+        self.client_rate = client_rate
+        self.lockout_after = lockout_after
+        self._buckets: OrderedDict = OrderedDict()
+        self._failures: OrderedDict = OrderedDict()
+
+    def _remember(self, store: OrderedDict, key, value) -> None:
+        store[key] = value
+        store.move_to_end(key)
+        while len(store) > _THROTTLE_MAX_KEYS:
+            store.popitem(last=False)
+
+    def _take(self, key, rate: float, now: float) -> float:
+        """0 — токен взят, иначе сколько секунд ждать следующего."""
+        burst = max(1.0, rate * 2)
+        tokens, updated = self._buckets.get(key, (burst, now))
+        tokens = min(burst, tokens + (now - updated) * rate)
+        if tokens >= 1:
+            self._remember(self._buckets, key, (tokens - 1, now))
+            return 0.0
+        self._remember(self._buckets, key, (tokens, now))
+        return (1 - tokens) / rate
+
+    def check(self, ip: str, client: str | None) -> float:
+        now = time.monotonic()
+        failure = self._failures.get((client, ip))
+        if failure is not None and failure[2] > now:
+            return failure[2] - now
+        wait = self._take(("ip", ip), self.ip_rate, now)
+        if not wait and client is not None:
+            wait = self._take(("client", client), self.client_rate, now)
+        return wait
+
+    def record_failures(self, ip: str, client: str | None, count: int) -> None:
+        now = time.monotonic()
+        key = (client, ip)
+        failures, last, locked_until = self._failures.get(key, (0, now, 0.0))
+        if now - last > _FAILURE_WINDOW:
+            failures = 0
+        lockouts_before = failures // self.lockout_after
+        failures += count
+        lockouts = failures // self.lockout_after
+        if lockouts > lockouts_before:
+            duration = min(_LOCKOUT_BASE * 2 ** (lockouts - 1), _LOCKOUT_MAX)
+            locked_until = now + duration
+            logger.warning(
+                "promo API lockout: ip=%s client=%s failures=%s for %.0f s",
+                ip, client, failures, duration,
+            )
+        self._remember(self._failures, key, (failures, now, locked_until))
+
+
+_throttle = _Throttle(
+    ip_rate=config.PROMO_API_RATE,
+    client_rate=config.PROMO_API_CLIENT_RATE,
+    lockout_after=config.PROMO_API_LOCKOUT_AFTER,
+)
+
+
+# Прокси, которым доверяем X-Forwarded-For: "*" — любой (Render: прокси не имеет
+# постоянного адреса, а напрямую к сервису не подключиться), иначе адреса и подсети.
+_TRUST_ANY_PROXY = config.PROMO_API_TRUSTED_PROXIES.strip() == "*"
+_TRUSTED_PROXIES = [
+    ipaddress.ip_network(item.strip(), strict=False)
+    for item in config.PROMO_API_TRUSTED_PROXIES.split(",")
+    if item.strip() and not _TRUST_ANY_PROXY
+]
+
+
+def _from_trusted_proxy(remote_ip: str) -> bool:
+    if _TRUST_ANY_PROXY:
+        return True
+    try:
+        address = ipaddress.ip_address(remote_ip)
+    except ValueError:
+        return False
+    return any(address in network for network in _TRUSTED_PROXIES)
+
+
+def _client_ip(handler: tornado.web.RequestHandler) -> str:
+    """
+    IP клиента. За доверенным прокси (PROMO_API_TRUSTED_PROXIES) — последний адрес
+    X-Forwarded-For: его дописал сам прокси, а начало заголовка клиент может подставить
+    любое. Без прокси заголовок игнорируется — иначе каждый запрос получал бы новый лимит.
+    """
+    remote_ip = handler.request.remote_ip or ""
+    forwarded = handler.request.headers.get("X-Forwarded-For", "")
+    if forwarded and _from_trusted_proxy(remote_ip):
+        return forwarded.split(",")[-1].strip()
+    return remote_ip
+
+
+class _PromoHandler(tornado.web.RequestHandler):
+    """
+    Общее для /api/promo/*: JSON-ответы, клиент API, лимиты и учёт. prepare() до обращения
+    к базе отклоняет запрос: 429 с Retry-After, 401 без клиента, 403, если эндпоинт клиенту
+    не разрешён. on_finish() считает 401/404 (и not_found в batch — misses) для блокировки
+    перебора кодов, успешный ответ без промахов обнуляет серию; запрос пишется в счётчики клиента.
+    """
+
+    # Имя эндпоинта в api_clients.endpoints.
+    ENDPOINT = ""
 
     def set_default_headers(self) -> None:
         self.set_header("Content-Type", "application/json; charset=utf-8")
 
-    async def post(self) -> None:
-        if not _check_auth(self):
+    async def prepare(self) -> None:
+        await _clients.ensure_fresh()
+        client = _authenticate(self)
+        self.client = client["name"] if client else None
+        self.discount_percent = (
+            client["discount_percent"]
+            if client and client["discount_percent"] is not None
+            else config.PROMO_DISCOUNT_PERCENT
+        )
+        self.ip = _client_ip(self)
+        self.misses = 0
+        wait = _throttle.check(self.ip, self.client)
+        if wait:
+            self.set_status(429)
+            self.set_header("Retry-After", str(math.ceil(wait)))
+            self.finish(json.dumps({"ok": False, "error": "rate_limited"}))
+        elif client is None:
             self.set_status(401)
-            self.write(json.dumps({"ok": False, "error": "unauthorized"}))
-            return
+            self.finish(json.dumps({"ok": False, "error": "unauthorized"}))
+        elif client["endpoints"] and self.ENDPOINT not in client["endpoints"]:
+            self.set_status(403)
+            self.finish(json.dumps({"ok": False, "error": "forbidden"}))
+
+    def on_finish(self) -> None:
+        status = self.get_status()
+        misses = self.misses + (status in (401, 404))
+        if misses:
+            _throttle.record_failures(self.ip, self.client, misses)
+        _record_usage(self.client or "anonymous", self.ENDPOINT, status, self.request.request_time())
+
+
+class PromoRedeemHandler(_PromoHandler):
+    SUPPORTED_METHODS = ("POST",)
+    ENDPOINT = "redeem"
 
+    async def post(self) -> None:
         try:
             body = json.loads(self.request.body.decode() or "{}")
         except json.JSONDecodeError:
@@ -50,29 +427,208 @@ class PromoRedeemHandler(tornado.web.RequestHandler):
             self.write(json.dumps({"ok": False, "error": "invalid_json"}))
             return
 
-        code = body.get("code", "")
+        code = body.get("code", "") if isinstance(body, dict) else None
+        if not isinstance(code, str):
+            _REDEEM_OUTCOMES.inc(self.ENDPOINT, "invalid_format")
+            self.set_status(_REDEEM_ERRORS["invalid_format"])
+            self.write(json.dumps({"ok": False, "error": "invalid_format"}))
+            return
+        code_key = db.normalize_promo_code(code) or code
+        idempotency_key = self.request.headers.get("Idempotency-Key")
+        if idempotency_key is not None:
+            idempotency_key = idempotency_key.strip()
+            if not idempotency_key or len(idempotency_key) > _IDEMPOTENCY_KEY_MAX_LEN:
+                self.set_status(400)
+                self.write(json.dumps({"ok": False, "error": "invalid_idempotency_key"}))
+                return
+            replay = _idempotency_cache.get((self.client, idempotency_key))
+            if replay is not db.MISSING:
+                replay_code, status, response = replay
+                if replay_code != code_key:
+                    outcome = "idempotency_key_reused"
+                    status = _REDEEM_ERRORS[outcome]
+                    response = json.dumps({"ok": False, "error": outcome})
+                else:
+                    outcome = "replayed"
+                    self.set_header("Idempotent-Replayed", "true")
+                _REDEEM_OUTCOMES.inc(self.ENDPOINT, outcome)
+                self.set_status(status)
+                self.write(response)
+                return
+
         try:
             result = await db.redeem_promo_code(
                 code,
-                discount_percent=config.PROMO_DISCOUNT_PERCENT,
+                discount_percent=self.discount_percent,
+                idempotency_key=idempotency_key and f"{self.client}:{idempotency_key}",
             )
         except db.PromoRedeemError as exc:
-            self.set_status(_REDEEM_ERRORS.get(exc.code, 400))
-            self.write(json.dumps({"ok": False, "error": exc.code}))
-            return
+            outcome = exc.code
+            status = _REDEEM_ERRORS.get(exc.code, 400)
+            response = json.dumps({"ok": False, "error": exc.code})
         except Exception:
             logger.exception("promo redeem failed for code=%r", code)
+            _REDEEM_OUTCOMES.inc(self.ENDPOINT, "internal_error")
             self.set_status(500)
             self.write(json.dumps({"ok": False, "error": "internal_error"}))
             return
+        else:
+            logger.info("promo redeemed: code=%s user_id=%s", result["code"], result["user_id"])
+            _lookup_cache.pop(result["code"])
+            outcome, status, response = "ok", 200, json.dumps({"ok": True, **result})
+
+        _REDEEM_OUTCOMES.inc(self.ENDPOINT, outcome)
+        if idempotency_key is not None and status != _REDEEM_ERRORS["idempotency_key_reused"]:
+            _idempotency_cache.set((self.client, idempotency_key), (code_key, status, response))
+        self.set_status(status)
+        self.write(response)
+
+
+class _PromoBatchHandler(_PromoHandler, abc.ABC):
+    """
+    Тело: {"codes": ["NR-…", …]} — не больше PROMO_API_BATCH_LIMIT.
+    Ответ 200: {"ok": true, "results": [...]} в порядке запроса; у каждого кода — ok и,
+    при отказе, error из словаря _REDEEM_ERRORS.
+    """
+
+    SUPPORTED_METHODS = ("POST",)
+
+    @abc.abstractmethod
+    async def process(self, codes: list) -> list[dict]:
+        """Результаты по каждому коду, в порядке запроса."""
+
+    async def post(self) -> None:
+        try:
+            body = json.loads(self.request.body.decode() or "{}")
+        except json.JSONDecodeError:
+            self.set_status(400)
+            self.write(json.dumps({"ok": False, "error": "invalid_json"}))
+            return
 
-        logger.info("promo redeemed: code=%s user_id=%s", result["code"], result["user_id"])
+        codes = body.get("codes") if isinstance(body, dict) else None
+        if not isinstance(codes, list):
+            self.set_status(400)
+            self.write(json.dumps({"ok": False, "error": "invalid_codes"}))
+            return
+        if len(codes) > config.PROMO_API_BATCH_LIMIT:
+            self.set_status(413)
+            self.write(json.dumps({
+                "ok": False,
+                "error": "too_many_codes",
+                "limit": config.PROMO_API_BATCH_LIMIT,
+            }))
+            return
+
+        try:
+            results = await self.process(codes)
+        except Exception:
+            logger.exception("promo batch failed: %s (%s codes)", self.request.path, len(codes))
+            self.set_status(500)
+            self.write(json.dumps({"ok": False, "error": "internal_error"}))
+            return
+
+        self.misses = sum(r.get("error") == "not_found" for r in results)
         self.set_status(200)
-        self.write(json.dumps({"ok": True, **result}))
+        self.write(json.dumps({"ok": True, "results": results}))
+
+
+class PromoRedeemBatchHandler(_PromoBatchHandler):
+    ENDPOINT = "redeem_batch"
+
+    async def process(self, codes: list) -> list[dict]:
+        results = await db.redeem_promo_codes(
+            codes,
+            discount_percent=self.discount_percent,
+        )
+        for r in results:
+            if r["ok"]:
+                _lookup_cache.pop(r["code"])
+            _REDEEM_OUTCOMES.inc(self.ENDPOINT, r.get("error") or "ok")
+        redeemed = sum(r["ok"] for r in results)
+        logger.info(
+            "promo batch redeemed by %s: %s of %s codes", self.client, redeemed, len(results)
+        )
+        return results
+
+
+class PromoValidateBatchHandler(_PromoBatchHandler):
+    ENDPOINT = "validate_batch"
+
+    async def process(self, codes: list) -> list[dict]:
+        return await db.validate_promo_codes(
+            codes,
+            discount_percent=self.discount_percent,
+        )
+
+
+class PromoLookupHandler(_PromoHandler):
+    """
+    GET /api/promo/{code} — проверка кода без погашения (подсказка на кассе во время ввода).
+    200: {"ok": true, "code", "status": active | already_used | expired, "valid_until",
+    "discount_percent"}; 404 not_found; 400 invalid_format.
+    Ответ кэшируется в памяти на PROMO_API_LOOKUP_TTL; If-None-Match → 304.
+    """
+
+    SUPPORTED_METHODS = ("GET",)
+    ENDPOINT = "lookup"
+
+    async def get(self, code: str) -> None:
+        normalized = db.normalize_promo_code(code)
+        if not normalized:
+            self.set_status(400)
+            self.write(json.dumps({"ok": False, "error": "invalid_format"}))
+            return
+
+        entry = _lookup_cache.get(normalized)
+        if entry is db.MISSING:
+            generation = _lookup_cache.generation()
+            try:
+                promo = await db.get_promo_status(normalized)
+            except Exception:
+                logger.exception("promo lookup failed for code=%r", normalized)
+                self.set_status(500)
+                self.write(json.dumps({"ok": False, "error": "internal_error"}))
+                return
+            entry = (404, None) if promo is None else (200, promo)
+            _lookup_cache.set(normalized, entry, generation)
+
+        status, promo = entry
+        if promo is None:
+            body = json.dumps({"ok": False, "error": "not_found"})
+        else:
+            # Скидка у клиентов может отличаться — в кэше только состояние кода.
+            body = json.dumps({"ok": True, **promo, "discount_percent": self.discount_percent})
+        self.set_status(status)
+        self.set_header("Cache-Control", f"private, max-age={config.PROMO_API_LOOKUP_TTL}")
+        self.set_header("Etag", f'"{hashlib.sha1(body.encode()).hexdigest()}"')
+        if status == 200 and self.check_etag_header():
+            self.set_status(304)
+            return
+        self.write(body)
+
+
+ROUTES = [
+    (r"/api/promo/redeem/batch/?", PromoRedeemBatchHandler),
+    (r"/api/promo/validate/batch/?", PromoValidateBatchHandler),
+    (r"/api/promo/redeem/?", PromoRedeemHandler),
+    (r"/api/promo/([^/]+)/?", PromoLookupHandler),
+]
+# Порт API и webhook публичный: /metrics на нём — только под METRICS_TOKEN.
+if config.METRICS_TOKEN:
+    ROUTES.append((r"/metrics", metrics.MetricsHandler))
+
+
+def make_app(*, metrics_route: bool = True) -> tornado.web.Application:
+    """Отдельное приложение API — для python -m promo_api."""
+    if metrics_route:
+        return tornado.web.Application(ROUTES)
+    return tornado.web.Application(
+        [route for route in ROUTES if route[1] is not metrics.MetricsHandler]
+    )
 
 
 def patch_webhook_app() -> None:
-    """Добавляет /api/promo/redeem к Tornado-приложению webhook PTB."""
+    """Добавляет /api/promo/* и /metrics (если задан METRICS_TOKEN) к приложению webhook PTB."""
     from telegram.ext import _updater as updater_module
     from telegram.ext._utils import webhookhandler as wh
 
@@ -92,10 +648,7 @@ def patch_webhook_app() -> None:
                 "update_queue": update_queue,
                 "secret_token": secret_token,
             }
-            handlers = [
-                (r"/api/promo/redeem/?", PromoRedeemHandler),
-                (rf"{webhook_path}/?", wh.TelegramHandler, shared),
-            ]
+            handlers = [*ROUTES, (rf"{webhook_path}/?", wh.TelegramHandler, shared)]
             super().__init__(handlers)
 
         def log_request(self, handler: tornado.web.RequestHandler) -> None:
@@ -105,4 +658,150 @@ def patch_webhook_app() -> None:
     wh.WebhookAppClass = PatchedWebhookApp  # type: ignore[misc, assignment]
     updater_module.WebhookAppClass = PatchedWebhookApp  # type: ignore[misc, assignment]
     wh.WebhookAppClass._promo_api_patched = True
-    logger.info("Promo API route registered: POST /api/promo/redeem")
+    logger.info(
+        "Promo API routes registered: POST /api/promo/redeem,"
+        " /api/promo/redeem/batch, /api/promo/validate/batch; GET /api/promo/{code}%s",
+        ", /metrics" if config.METRICS_TOKEN else "",
+    )
+
+
+# ── Отдельный сервер: python -m promo_api ─────────────────────────
+# Не зависит от режима бота (webhook или polling) и не делит с ним event loop.
+# PROMO_API_WORKERS > 1 — prefork: каждый процесс со своим loop и соединениями к Turso;
+# на Linux у каждого свой сокет с SO_REUSEPORT (ядро само раскладывает соединения),
+# иначе процессы делят один сокет, открытый до fork. Лимиты и кэши — на процесс.
+
+
+async def _serve(sockets: list[socket.socket], number: int, workers: int) -> None:
+    # Процессов несколько — scrape общего порта попадал бы в случайный из них, и счётчики
+    # скакали бы между scrape. Поэтому у каждого свой порт METRICS_PORT + номер и метка worker.
+    server = tornado.httpserver.HTTPServer(make_app(metrics_route=workers == 1))
+    server.add_sockets(sockets)
+    metrics_server = None
+    if config.METRICS_PORT:
+        metrics.set_process_labels(worker=str(number))
+        metrics_server = metrics.start_server(config.METRICS_PORT + number)
+        logger.info(
+            "Promo API: метрики процесса %s — порт %s", number, config.METRICS_PORT + number
+        )
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+    server.stop()
+    if metrics_server is not None:
+        metrics_server.stop()
+    try:
+        await flush_usage()
+    except db.TursoError as e:
+        logger.warning("promo API usage flush failed: %s", e)
+    await server.close_all_connections()
+    await db.close()
+
+
+def _run_worker(number: int, workers: int, sockets: list[socket.socket] | None) -> None:
+    if sockets is None:
+        sockets = tornado.netutil.bind_sockets(config.PROMO_API_PORT, reuse_port=True)
+    logger.info("Promo API: порт %s, процесс %s/%s", config.PROMO_API_PORT, number, workers)
+    asyncio.run(_serve(sockets, number, workers))
+
+
+# Перезапуск упавших процессов: пауза 1 с, 2 с, 4 с… (до минуты) для процесса, падающего
+# сразу после старта; _CRASH_LIMIT падений за _CRASH_WINDOW — сбой не временный
+# (порт занят, Turso недоступна), и родитель завершается с ненулевым кодом.
+_RESTART_DELAY_BASE = 1.0
+_RESTART_DELAY_MAX = 60.0
+_CRASH_LIMIT = 5
+_CRASH_WINDOW = 60.0
+
+
+def _prefork(workers: int, sockets: list[socket.socket] | None) -> None:
+    """Запускает процессы, пересылает им SIGTERM/SIGINT, перезапускает упавшие."""
+    children: dict[int, tuple[int, float]] = {}
+    # Номер процесса → сколько раз подряд он упал, не проработав _CRASH_WINDOW.
+    quick_crashes: dict[int, int] = {}
+    crashes: list[float] = []
+    stopping = gave_up = False
+
+    def spawn(number: int) -> None:
+        pid = os.fork()
+        if pid == 0:
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                signal.signal(sig, signal.SIG_DFL)
+            code = 0
+            try:
+                _run_worker(number, workers, sockets)
+            except Exception:
+                logger.exception("Promo API: процесс %s упал", number)
+                code = 1
+            finally:
+                os._exit(code)
+        children[pid] = (number, time.monotonic())
+
+    def forward(signum, frame) -> None:
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            os.kill(pid, signum)
+
+    signal.signal(signal.SIGINT, forward)
+    signal.signal(signal.SIGTERM, forward)
+    for number in range(1, workers + 1):
+        spawn(number)
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        number, started = children.pop(pid)
+        if stopping or os.waitstatus_to_exitcode(status) == 0:
+            continue
+        now = time.monotonic()
+        crashes[:] = [moment for moment in crashes if now - moment < _CRASH_WINDOW] + [now]
+        if len(crashes) >= _CRASH_LIMIT:
+            logger.error(
+                "Promo API: %s падений за %.0f с — останавливаюсь", len(crashes), _CRASH_WINDOW
+            )
+            gave_up = True
+            forward(signal.SIGTERM, None)
+            continue
+        quick = now - started < _CRASH_WINDOW
+        quick_crashes[number] = quick_crashes.get(number, 0) + 1 if quick else 1
+        delay = min(_RESTART_DELAY_BASE * 2 ** (quick_crashes[number] - 1), _RESTART_DELAY_MAX)
+        logger.warning("Promo API: перезапускаю процесс %s через %.0f с", number, delay)
+        time.sleep(delay)
+        if not stopping:
+            spawn(number)
+    if gave_up:
+        sys.exit(1)
+
+
+def main() -> None:
+    logging.basicConfig(
+        format="%(asctime)s - %(process)d - %(name)s - %(levelname)s - %(message)s",
+        level=logging.INFO,
+    )
+    if not config.TURSO_URL or not config.TURSO_TOKEN:
+        raise RuntimeError("TURSO_URL или TURSO_TOKEN не заданы в .env файле")
+
+    # Миграции — один раз, до fork; HTTP-клиент закрываем, чтобы процессы не делили соединения.
+    async def migrate() -> None:
+        await db.migrate()
+        await db.close()
+
+    asyncio.run(migrate())
+
+    workers = config.PROMO_API_WORKERS or os.cpu_count() or 1
+    if workers > 1 and not hasattr(os, "fork"):
+        logger.warning("Promo API: fork недоступен, запускаю один процесс")
+        workers = 1
+    if workers == 1:
+        _run_worker(1, 1, tornado.netutil.bind_sockets(config.PROMO_API_PORT))
+        return
+    reuse_port = hasattr(socket, "SO_REUSEPORT")
+    _prefork(workers, None if reuse_port else tornado.netutil.bind_sockets(config.PROMO_API_PORT))
+
+
+if __name__ == "__main__":
+    main()
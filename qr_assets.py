@@ -0,0 +1,121 @@
+"""QR-коды бота и зон карты: рендер вне event loop, кэш PNG и file_id Telegram."""
+
+from __future__ import annotations
+
+import asyncio
+import io
+import logging
+import zipfile
+
+from telegram.error import BadRequest
+
+import database as db
+import executor
+
+logger = logging.getLogger(__name__)
+
+# Лист для печати: A4 при 150 dpi, сетка 4×6 (главный QR + 21 зона помещаются).
+_SHEET_SIZE = (1240, 1754)
+_SHEET_COLS = 4
+_SHEET_ROWS = 6
+_SHEET_QR_SIZE = 240
+
+_png_cache: dict[str, bytes] = {}
+
+
+def _render_png(url: str) -> bytes:
+    import qrcode
+
+    buf = io.BytesIO()
+    qrcode.make(url).save(buf, format="PNG")
+    return buf.getvalue()
+
+
+async def get_png(url: str) -> bytes:
+    """PNG QR-кода для url; рендер — в пуле CPU, чтобы не блокировать event loop."""
+    png = _png_cache.get(url)
+    if png is None:
+        png = await executor.run_cpu(_render_png, url)
+        _png_cache[url] = png
+    return png
+
+
+async def prerender(urls: list[str]) -> None:
+    """Рендерит все QR заранее (фоновая задача из post_init)."""
+    try:
+        await asyncio.gather(*(get_png(url) for url in urls))
+    except ImportError:
+        logger.warning("qrcode не установлен — QR-коды не подготовлены")
+
+
+async def reply_qr(message, url: str, **kwargs):
+    """
+    Отправляет QR: по сохранённому file_id, если он есть (и Telegram его принимает),
+    иначе загружает PNG и запоминает file_id из ответа Telegram.
+    """
+    cache_key = f"qr_file_id:{url}"
+    try:
+        file_id = await db.get_setting(cache_key)
+    except Exception:
+        file_id = None
+    if file_id:
+        try:
+            return await message.reply_photo(photo=file_id, **kwargs)
+        except BadRequest as e:
+            logger.warning("cached QR file_id for %s rejected, re-uploading: %s", url, e)
+
+    sent = await message.reply_photo(photo=await get_png(url), **kwargs)
+    if sent.photo:
+        try:
+            await db.set_setting(cache_key, sent.photo[-1].file_id)
+        except db.TursoError as e:
+            logger.warning("could not cache QR file_id for %s: %s", url, e)
+    return sent
+
+
+def _build_zip(items: list[tuple[str, bytes]]) -> bytes:
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
+        for filename, png in items:
+            zf.writestr(filename, png)
+    return buf.getvalue()
+
+
+def _build_pdf_sheet(items: list[tuple[str, bytes]]) -> bytes:
+    from PIL import Image, ImageDraw, ImageFont
+
+    font = ImageFont.load_default()
+    pages = []
+    per_page = _SHEET_COLS * _SHEET_ROWS
+    cell_w = _SHEET_SIZE[0] // _SHEET_COLS
+    cell_h = _SHEET_SIZE[1] // _SHEET_ROWS
+    for start in range(0, len(items), per_page):
+        page = Image.new("RGB", _SHEET_SIZE, "white")
+        draw = ImageDraw.Draw(page)
+        for i, (label, png) in enumerate(items[start:start + per_page]):
+            col, row = i % _SHEET_COLS, i // _SHEET_COLS
+            qr = Image.open(io.BytesIO(png)).convert("RGB").resize(
+                (_SHEET_QR_SIZE, _SHEET_QR_SIZE), Image.NEAREST
+            )
+            x = col * cell_w + (cell_w - _SHEET_QR_SIZE) // 2
+            y = row * cell_h + 10
+            page.paste(qr, (x, y))
+            draw.text((x, y + _SHEET_QR_SIZE + 4), label, fill="black", font=font)
+        pages.append(page)
+    buf = io.BytesIO()
+    pages[0].save(buf, format="PDF", save_all=True, append_images=pages[1:], resolution=150)
+    return buf.getvalue()
+
+
+async def build_zip(items: list[tuple[str, str]]) -> bytes:
+    """items: (имя файла, url) → ZIP с PNG."""
+    pngs = await asyncio.gather(*(get_png(url) for _, url in items))
+    return await executor.run_blocking(_build_zip, [(name, png) for (name, _), png in zip(items, pngs)])
+
+
+async def build_pdf_sheet(items: list[tuple[str, str]]) -> bytes:
+    """items: (подпись латиницей/цифрами, url) → PDF A4 с сеткой QR для печати."""
+    pngs = await asyncio.gather(*(get_png(url) for _, url in items))
+    return await executor.run_cpu(
+        _build_pdf_sheet, [(label, png) for (label, _), png in zip(items, pngs)]
+    )